@@ -0,0 +1,88 @@
+
+import analytics
+
+import itertools
+import math
+import random
+import numpy as np
+
+# Adaptive tournament planning. Instead of playing a fixed number of round
+# robins, games are scheduled in waves. After each wave the Bradley-Terry
+# ratings of the teams are bootstrapped from the results so far. A pair of
+# teams is decided if one is the stronger team in at least the target
+# fraction of bootstrap samples. The next wave is spent on the undecided
+# pairs, the tournament ends once all neighbours in the ranking are decided
+# or the game budget is used up.
+
+class AdaptivePlanner(object):
+	def __init__(self, teams, budget, confidence=0.95, wave_size=None, min_games=1,
+	             samples=200, seed=None):
+		self.teams = list(teams)
+		self.pairings = list(itertools.permutations(self.teams, r=2))
+		self.budget = budget
+		self.confidence = confidence
+		self.wave_size = wave_size or len(self.pairings)
+		self.min_games = min_games
+		self.samples = samples
+		self.rng = random.Random(seed)
+		self.ranking = list(self.teams)
+		self.certainty = {}
+
+	def _update(self, snapshot):
+		# Ranking of the teams by rating and the certainty per unordered pair
+		# of teams that the higher ranked one is stronger. Teams without any
+		# result yet are ranked last and undecided against everyone.
+		index = {t: i for (i, t) in enumerate(snapshot.teams)}
+		rating = analytics.bradley_terry(snapshot)
+		self.ranking = sorted(self.teams, key=lambda t: -rating[index[t]] if t in index else math.inf)
+
+		samples = None
+		if snapshot.num_games > 0:
+			samples = analytics.bootstrap_samples(snapshot, analytics.bradley_terry, self.samples,
+			                                      seed=self.rng.randrange(2**31))
+		self.certainty = {}
+		for (a, b) in itertools.combinations(self.ranking, 2):
+			p = 0.5
+			if samples is not None and a in index and b in index:
+				p = np.mean(samples[:, index[a]] > samples[:, index[b]]) + \
+				    0.5 * np.mean(samples[:, index[a]] == samples[:, index[b]])
+			self.certainty[(a, b)] = max(p, 1.0 - p)
+
+	def undecided(self):
+		return [pair for (pair, c) in self.certainty.items() if c < self.confidence]
+
+	def decided(self):
+		# The ranking is decided if each team is decided against its successor
+		return all(self.certainty.get(pair, 0.5) >= self.confidence
+		           for pair in zip(self.ranking, self.ranking[1:]))
+
+	def next_wave(self, snapshot, scheduled):
+		# List of (cyan, magenta) pairings to play next, empty if the ranking
+		# is decided or the budget is used up. snapshot contains the results
+		# so far, scheduled maps pairings to the number of games enqueued.
+		remaining = self.budget - sum(scheduled.values())
+
+		# Every pairing is played min_games times before allocating adaptively
+		initial = [p for p in self.pairings for _ in range(self.min_games - scheduled.get(p, 0))]
+		if initial and remaining > 0:
+			return initial[:remaining]
+
+		self._update(snapshot)
+		if remaining <= 0 or self.decided():
+			return []
+
+		# Least certain pairs first, ties broken by fewer games so far
+		def num_games(pair):
+			return scheduled.get(pair, 0) + scheduled.get((pair[1], pair[0]), 0)
+		candidates = sorted(self.undecided(), key=lambda pair: (self.certainty[pair], num_games(pair)))
+
+		wave = []
+		counts = dict(scheduled)
+		wave_size = min(self.wave_size, remaining)
+		while len(wave) < wave_size:
+			for (a, b) in candidates[:wave_size - len(wave)]:
+				# Play the pairing in the orientation played less often so far
+				p = (a, b) if counts.get((a, b), 0) <= counts.get((b, a), 0) else (b, a)
+				counts[p] = counts.get(p, 0) + 1
+				wave.append(p)
+		return wave
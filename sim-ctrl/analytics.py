@@ -0,0 +1,292 @@
+
+import datetime
+import json
+import math
+import os
+
+import numpy as np
+
+# Tournament analytics on a columnar snapshot of the refbox game reports.
+# A snapshot holds one row per game in NumPy arrays, teams are stored as
+# indices into the snapshot's team list. Snapshots are saved as a directory
+# of .npy files which can be memory-mapped when loaded again.
+
+DELIVERY_REASON = "Delivered item for order 1"
+SNAPSHOT_COLUMNS = ["job_name", "team_cyan", "team_magenta",
+                    "points_cyan", "points_magenta",
+                    "delivery_time_cyan", "delivery_time_magenta"]
+CREATED_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+# Ratings are reported on the Elo scale, a difference of 400 points
+# corresponds to odds of 10:1
+RATING_BASE = 1500.0
+RATING_SCALE = 400.0
+
+def tournament_regex(tournament):
+	return { "$regex": "^%s:\d+:.*" % tournament}
+
+class Snapshot(object):
+	def __init__(self, tournament, teams, columns, created=None):
+		self.tournament = tournament
+		self.teams = list(teams)
+		self.created = created or datetime.datetime.utcnow()
+		for c in SNAPSHOT_COLUMNS:
+			setattr(self, c, columns[c])
+
+	@property
+	def num_games(self):
+		return len(self.job_name)
+
+	def columns(self):
+		return {c: getattr(self, c) for c in SNAPSHOT_COLUMNS}
+
+	def save(self, directory):
+		os.makedirs(directory, exist_ok=True)
+		for (name, column) in self.columns().items():
+			np.save(os.path.join(directory, name + ".npy"), column)
+		with open(os.path.join(directory, "meta.json"), 'w') as f:
+			json.dump({ "tournament": self.tournament,
+			            "created": self.created.strftime(CREATED_FORMAT),
+			            "num_games": self.num_games,
+			            "teams": self.teams }, f, indent=2)
+
+	@staticmethod
+	def load(directory, mmap=True):
+		with open(os.path.join(directory, "meta.json")) as f:
+			meta = json.load(f)
+		columns = {}
+		for name in SNAPSHOT_COLUMNS:
+			columns[name] = np.load(os.path.join(directory, name + ".npy"),
+			                        mmap_mode='r' if mmap else None)
+		created = datetime.datetime.strptime(meta["created"], CREATED_FORMAT)
+		return Snapshot(meta["tournament"], meta["teams"], columns, created)
+
+	def take(self, rows):
+		# Subset of games by index or mask, the team list is kept
+		columns = {name: column[rows] for (name, column) in self.columns().items()}
+		return Snapshot(self.tournament, self.teams, columns, self.created)
+
+	def select_teams(self, teams):
+		# Games in which both teams are among the given ones, the team
+		# list is reduced to the teams actually playing
+		team_ids = [i for (i, t) in enumerate(self.teams) if t in teams]
+		mask = np.isin(self.team_cyan, team_ids) & np.isin(self.team_magenta, team_ids)
+		subset = self.take(mask)
+		(used, inverse) = np.unique(np.concatenate((subset.team_cyan, subset.team_magenta)),
+		                            return_inverse=True)
+		subset.teams = [self.teams[i] for i in used]
+		subset.team_cyan = inverse[:subset.num_games].astype(np.int32)
+		subset.team_magenta = inverse[subset.num_games:].astype(np.int32)
+		return subset
+
+def export_snapshot(game_report_collection, tournament, teams=None):
+	teams_condition = { "$ne": "" }
+	if teams:
+		teams_condition = { "$in": list(teams) }
+
+	def first_delivery(team):
+		return { "$filter":
+		         { "input": "$points", "as": "p",
+		           "cond": { "$and": [ {"$eq": ["$$p.team", team] },
+		                               {"$eq": ["$$p.reason", DELIVERY_REASON]}]}}}
+
+	# Reduce the reports to the snapshot columns on the server, the
+	# points array of a report is by far its largest part
+	cursor = game_report_collection.aggregate(\
+		[{"$match":
+		  {"job_name": tournament_regex(tournament),
+		   "teams.0": teams_condition,
+		   "teams.1": teams_condition}},
+		 {"$project":
+		  { "_id": 0,
+		    "job_name": 1,
+		    "teams": 1,
+		    "total-points": 1,
+		    "delivery_cyan": first_delivery("CYAN"),
+		    "delivery_magenta": first_delivery("MAGENTA")}},
+		 {"$project":
+		  { "job_name": 1, "teams": 1, "total-points": 1,
+		    "delivery_time_cyan": { "$arrayElemAt": ["$delivery_cyan.game-time", 0]},
+		    "delivery_time_magenta": { "$arrayElemAt": ["$delivery_magenta.game-time", 0]}}},
+		 {"$sort": { "job_name": 1 }}],
+		allowDiskUse=True)
+
+	team_ids = {}
+	rows = {c: [] for c in SNAPSHOT_COLUMNS}
+	for d in cursor:
+		rows["job_name"].append(d["job_name"])
+		rows["team_cyan"].append(team_ids.setdefault(d["teams"][0], len(team_ids)))
+		rows["team_magenta"].append(team_ids.setdefault(d["teams"][1], len(team_ids)))
+		rows["points_cyan"].append(d["total-points"][0])
+		rows["points_magenta"].append(d["total-points"][1])
+		rows["delivery_time_cyan"].append(d.get("delivery_time_cyan", math.nan))
+		rows["delivery_time_magenta"].append(d.get("delivery_time_magenta", math.nan))
+
+	columns = { "job_name": np.array(rows["job_name"], dtype=np.str_) }
+	for c in ["team_cyan", "team_magenta", "points_cyan", "points_magenta"]:
+		columns[c] = np.array(rows[c], dtype=np.int32)
+	for c in ["delivery_time_cyan", "delivery_time_magenta"]:
+		columns[c] = np.array(rows[c], dtype=np.float64)
+	teams = sorted(team_ids, key=team_ids.get)
+	return Snapshot(tournament, teams, columns)
+
+def _outcomes(snapshot):
+	# Score of the cyan team per game, 1 for a win, 0.5 for a draw
+	return np.sign(snapshot.points_cyan - snapshot.points_magenta) * 0.5 + 0.5
+
+def _per_team(snapshot, cyan_values, magenta_values):
+	num_teams = len(snapshot.teams)
+	return np.bincount(snapshot.team_cyan, weights=cyan_values, minlength=num_teams) + \
+	       np.bincount(snapshot.team_magenta, weights=magenta_values, minlength=num_teams)
+
+def team_results(snapshot):
+	# Per team totals as arrays indexed like snapshot.teams
+	outcome = _outcomes(snapshot)
+	cyan_win = (outcome == 1.0).astype(np.int64)
+	magenta_win = (outcome == 0.0).astype(np.int64)
+	draw = (outcome == 0.5).astype(np.int64)
+	points_max = np.zeros(len(snapshot.teams), dtype=np.int64)
+	np.maximum.at(points_max, snapshot.team_cyan, snapshot.points_cyan)
+	np.maximum.at(points_max, snapshot.team_magenta, snapshot.points_magenta)
+	results = { "games": _per_team(snapshot, np.ones(snapshot.num_games), np.ones(snapshot.num_games)),
+	            "wins": _per_team(snapshot, cyan_win, magenta_win),
+	            "defeats": _per_team(snapshot, magenta_win, cyan_win),
+	            "draws": _per_team(snapshot, draw, draw),
+	            "points": _per_team(snapshot, snapshot.points_cyan, snapshot.points_magenta),
+	            "points_against": _per_team(snapshot, snapshot.points_magenta, snapshot.points_cyan) }
+	results = {k: v.astype(np.int64) for (k, v) in results.items()}
+	results["points_max"] = points_max
+	return results
+
+def ranking(snapshot, results=None):
+	# List of (wins, [teams]) ordered by decreasing wins, teams without any
+	# win are not ranked
+	if results is None:
+		results = team_results(snapshot)
+	wins = results["wins"]
+	rank = []
+	for w in np.unique(wins[wins > 0])[::-1]:
+		rank.append((int(w), [snapshot.teams[i] for i in np.flatnonzero(wins == w)]))
+	return rank
+
+def _group_by_team(snapshot, cyan_values, magenta_values):
+	# List of value arrays per team, sorted ascending
+	team = np.concatenate((snapshot.team_cyan, snapshot.team_magenta))
+	values = np.concatenate((cyan_values, magenta_values))
+	order = np.lexsort((values, team))
+	counts = np.bincount(team, minlength=len(snapshot.teams))
+	return np.split(values[order], np.cumsum(counts)[:-1])
+
+def team_scores(snapshot):
+	return _group_by_team(snapshot, snapshot.points_cyan, snapshot.points_magenta)
+
+def score_percentiles(snapshot, percentiles=(0, 25, 50, 75, 100)):
+	# Array of shape (teams, percentiles)
+	return np.array([np.percentile(s, percentiles) if len(s) > 0
+	                 else np.full(len(percentiles), math.nan)
+	                 for s in team_scores(snapshot)])
+
+def delivery_times(snapshot):
+	# First delivery times per team, games without a delivery are omitted
+	times = _group_by_team(snapshot, snapshot.delivery_time_cyan, snapshot.delivery_time_magenta)
+	return [t[~np.isnan(t)] for t in times]
+
+def delivery_histogram(snapshot, bins=10, time_range=None):
+	# Common bin edges and per team histograms of shape (teams, bins)
+	times = delivery_times(snapshot)
+	all_times = np.concatenate(times) if times else np.zeros(0)
+	edges = np.histogram(all_times, bins=bins, range=time_range)[1]
+	return (edges, np.array([np.histogram(t, bins=edges)[0] for t in times]))
+
+def bradley_terry(snapshot, prior=0.5, max_iterations=1000, tolerance=1e-9):
+	# Bradley-Terry strengths fitted with the MM algorithm (Hunter 2004).
+	# Draws count as half a win for each team. The prior adds virtual
+	# wins between all pairings, which keeps teams without wins or losses
+	# finite and the fit defined for disconnected pairings.
+	num_teams = len(snapshot.teams)
+	outcome = _outcomes(snapshot)
+	wins = np.zeros((num_teams, num_teams))
+	np.add.at(wins, (snapshot.team_cyan, snapshot.team_magenta), outcome)
+	np.add.at(wins, (snapshot.team_magenta, snapshot.team_cyan), 1.0 - outcome)
+	wins += prior * (1.0 - np.eye(num_teams))
+	games = wins + wins.T
+	total_wins = wins.sum(axis=1)
+
+	strength = np.ones(num_teams)
+	for i in range(max_iterations):
+		updated = total_wins / (games / (strength[:, None] + strength[None, :])).sum(axis=1)
+		updated /= np.exp(np.mean(np.log(updated)))
+		converged = np.max(np.abs(np.log(updated) - np.log(strength))) < tolerance
+		strength = updated
+		if converged:
+			break
+	return RATING_BASE + RATING_SCALE * np.log10(strength)
+
+def elo(snapshot, k=16.0):
+	# Sequential Elo ratings over the games in snapshot order
+	rating = np.full(len(snapshot.teams), RATING_BASE)
+	outcome = _outcomes(snapshot)
+	for (c, m, s) in zip(snapshot.team_cyan, snapshot.team_magenta, outcome):
+		expected = 1.0 / (1.0 + 10.0 ** ((rating[m] - rating[c]) / RATING_SCALE))
+		rating[c] += k * (s - expected)
+		rating[m] -= k * (s - expected)
+	return rating
+
+RATING_MODELS = { "bradley-terry": bradley_terry, "elo": elo }
+
+def bootstrap_samples(snapshot, model=bradley_terry, samples=1000, seed=None):
+	# Ratings of snapshots resampled from the games with replacement, array
+	# of shape (samples, teams)
+	rng = np.random.RandomState(seed)
+	ratings = np.empty((samples, len(snapshot.teams)))
+	for i in range(samples):
+		rows = np.sort(rng.randint(0, snapshot.num_games, snapshot.num_games))
+		ratings[i] = model(snapshot.take(rows))
+	return ratings
+
+def bootstrap_ratings(snapshot, model=bradley_terry, samples=1000, confidence=0.95, seed=None):
+	# Ratings with bootstrapped confidence intervals. Returns arrays
+	# (rating, low, high) indexed like teams.
+	ratings = bootstrap_samples(snapshot, model, samples, seed)
+	(low, high) = np.percentile(ratings, [50.0 * (1.0 - confidence), 50.0 * (1.0 + confidence)],
+	                            axis=0)
+	return (model(snapshot), low, high)
+
+def add_snapshot_arguments(parser, tournament_required=False):
+	parser.add_argument('--tournament', metavar='T-NAME', required=tournament_required,
+	                    help='Name of simulation tournament')
+	parser.add_argument('--snapshot', metavar='DIR',
+	                    help='Read game reports from a snapshot instead of the database.')
+	parser.add_argument('--save-snapshot', metavar='DIR',
+	                    help='Save a snapshot of the game reports to this directory.')
+
+def open_report_collection():
+	# The refbox game report collection on the work queue's database
+	# server. Imported here, snapshots can be analyzed without pymongo.
+	from work_queue import WorkQueue
+	from config import Configuration
+
+	config = Configuration()
+	wq = WorkQueue(host=config.mongodb_host,
+	               port=config.mongodb_port,
+	               uri=config.mongodb_uri,
+	               srv_name=config.mongodb_rs_srv,
+	               database=config.mongodb_queue_db,
+	               replicaset=config.mongodb_rs,
+	               collection=config.mongodb_queue_col)
+	return wq.client["refbox"]["game_report"]
+
+def snapshot_from_args(args, teams=None, open_collection=open_report_collection):
+	# open_collection returns the game report collection, it is only
+	# called if the snapshot is not read from disk
+	if args.snapshot:
+		snapshot = Snapshot.load(args.snapshot)
+		if teams:
+			snapshot = snapshot.select_teams(teams)
+	else:
+		if args.tournament is None:
+			raise ValueError("Either a tournament or a snapshot must be given")
+		snapshot = export_snapshot(open_collection(), args.tournament, teams)
+	if args.save_snapshot:
+		snapshot.save(args.save_snapshot)
+	return snapshot
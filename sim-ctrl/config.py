@@ -11,7 +11,42 @@ class Configuration(object):
 		self.mongodb_queue_col = self.value("MONGODB_QUEUE_COLLECTION", "q")
 		self.mongodb_rs_srv = self.value("MONGODB_RS_SRV")
 		self.template_path = self.value("TEMPLATE_PATH", "/opt/rcll-sim-ctrl/templates")
+		# None makes Jinja use a per-user directory in the system temp dir
+		self.template_cache_dir = self.value("TEMPLATE_CACHE_DIR")
 		self.kube_namespace = self.value("NAMESPACE", "default")
+		# Maximum number of concurrent Kubernetes API requests per controller
+		self.kube_api_workers = self.value("KUBE_API_WORKERS", "8")
+		# Maximum number of container logs downloaded concurrently
+		self.log_download_workers = self.value("LOG_DOWNLOAD_WORKERS", "4")
+		# Claimed jobs are leased for this many seconds, the lease is renewed
+		# every JOB_LEASE_HEARTBEAT seconds while the job is running
+		self.job_lease_duration = self.value("JOB_LEASE_DURATION", "600")
+		self.job_lease_heartbeat = self.value("JOB_LEASE_HEARTBEAT", "30")
+		# Automatically determined job namespaces are leased for this many
+		# seconds and renewed with the job leases
+		self.namespace_lease_duration = self.value("NAMESPACE_LEASE_DURATION", "900")
+		# Where to store retained logs, "filesystem" (below LOGS_BASEDIR)
+		# or "s3" (bucket LOGS_S3_BUCKET at LOGS_S3_ENDPOINT, e.g., Ceph RGW)
+		self.log_sink = self.value("LOG_SINK", "filesystem")
+		self.logs_basedir = self.value("LOGS_BASEDIR", "")
+		self.logs_s3_endpoint = self.value("LOGS_S3_ENDPOINT")
+		self.logs_s3_bucket = self.value("LOGS_S3_BUCKET")
+		self.logs_s3_prefix = self.value("LOGS_S3_PREFIX", "")
+		self.logs_s3_access_key = self.value("LOGS_S3_ACCESS_KEY")
+		self.logs_s3_secret_key = self.value("LOGS_S3_SECRET_KEY")
+		# Watchdog deadlines in seconds for all pods of a job to be up and
+		# for the game to finish afterwards, unless the templates of the job
+		# set setup_deadline or game_deadline. Empty or 0 disables them.
+		self.setup_deadline = self.value("SETUP_DEADLINE", "1200")
+		self.game_deadline = self.value("GAME_DEADLINE", "3600")
+		# Image pre-pull DaemonSet (cf. prepull-images) which controllers
+		# wait for before claiming their first job, at most PREPULL_TIMEOUT
+		# seconds. Empty to not wait.
+		self.prepull_daemonset = self.value("PREPULL_DAEMONSET", "")
+		self.prepull_timeout = self.value("PREPULL_TIMEOUT", "900")
+		# Port on which job timing metrics are served for Prometheus on
+		# /metrics, empty to disable
+		self.metrics_port = self.value("METRICS_PORT", "")
 
 	def value(self, key, default=None):
 		if key in os.environ:
@@ -0,0 +1,419 @@
+
+import kubernetes
+
+import bisect
+import collections
+import heapq
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+# In-process fake of the Kubernetes API endpoints used by the controller,
+# i.e., create, get, list, watch, patch (JSON patch with add, replace and
+# remove operations), delete, delete collection, and pod logs
+# for pods, services, config maps, service accounts, roles, role bindings,
+# ingresses and namespaces. It is served over HTTP, so that the real API
+# client, watches and log downloads are exercised. Request latencies are
+# configurable per verb and pods go through a scripted lifecycle:
+#
+#   created -> scheduled -> running (all containers ready)
+#           -> terminated (after "run" seconds, if set)
+#   deleted -> gone (after "terminate" seconds)
+#
+# The lifecycle defaults can be overridden per pod with annotations
+# fake-kube/<key>, e.g., fake-kube/run: "30" to let all containers of the
+# pod exit after 30 seconds, fake-kube/exit-code: "1" to let them fail, or
+# fake-kube/waiting-reason: "ImagePullBackOff" to keep the containers
+# waiting with that reason.
+
+LIFECYCLE_DEFAULTS = {
+	"schedule": 0.0,
+	"start": 0.0,
+	"run": None,
+	"terminate": 0.0,
+	"exit-code": 0,
+	"waiting-reason": None,
+}
+
+PATH_RE = re.compile(r'^/(api/v1|apis/[^/]+/[^/]+)(/namespaces/([^/]+))?/([a-z]+)(/([^/]+))?(/log)?$')
+
+KINDS = {
+	"pods": "Pod",
+	"services": "Service",
+	"configmaps": "ConfigMap",
+	"serviceaccounts": "ServiceAccount",
+	"secrets": "Secret",
+	"roles": "Role",
+	"rolebindings": "RoleBinding",
+	"ingresses": "Ingress",
+	"namespaces": "Namespace",
+}
+
+def _timestamp():
+	return datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def _parse_selector(selector):
+	# Returns a list of (key, op, value) for a label selector with equality
+	# and existence terms, e.g., "a=b,c!=d,e,!f"
+	terms = []
+	for term in [t.strip() for t in (selector or "").split(",") if t.strip()]:
+		if "!=" in term:
+			(key, value) = term.split("!=", 1)
+			terms.append((key, "!=", value))
+		elif "=" in term:
+			(key, value) = term.replace("==", "=").split("=", 1)
+			terms.append((key, "=", value))
+		elif term.startswith("!"):
+			terms.append((term[1:], "!", None))
+		else:
+			terms.append((term, "exists", None))
+	return terms
+
+def _matches(object, namespace, selector):
+	if namespace is not None and object["metadata"].get("namespace") != namespace:
+		return False
+	labels = object["metadata"].get("labels") or {}
+	for (key, op, value) in selector:
+		if op == "=" and labels.get(key) != value: return False
+		if op == "!=" and labels.get(key) == value: return False
+		if op == "exists" and key not in labels: return False
+		if op == "!" and key in labels: return False
+	return True
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+class FakeKubernetes(object):
+	def __init__(self, latency={}, jitter=0.0, lifecycle={}, log_size=64 * 1024, seed=None):
+		# latency maps verbs to seconds, jitter adds up to that fraction
+		self.latency = dict(latency)
+		self.jitter = jitter
+		self.lifecycle = dict(LIFECYCLE_DEFAULTS, **lifecycle)
+		self.log_size = log_size
+		self.rng = random.Random(seed)
+		self.objects = collections.defaultdict(dict)
+		# Per kind all events as (resource version, type, object) and their
+		# resource versions for lookups
+		self.events = collections.defaultdict(list)
+		self.event_versions = collections.defaultdict(list)
+		self.resource_version = 0
+		self.lock = threading.Condition()
+		self.timers = []
+		self.timer_seq = itertools.count()
+		self.api_calls = collections.Counter()
+		self.stopped = False
+		self.server = None
+		self.objects["namespaces"][(None, "default")] = \
+			{"kind": "Namespace", "apiVersion": "v1",
+			 "metadata": {"name": "default", "resourceVersion": "0"}}
+
+	@property
+	def url(self):
+		return "http://127.0.0.1:%d" % self.server.server_address[1]
+
+	def start(self, port=0):
+		fake = self
+		class Handler(BaseHTTPRequestHandler):
+			protocol_version = "HTTP/1.1"
+			def do_GET(self): fake._handle(self, "GET")
+			def do_POST(self): fake._handle(self, "POST")
+			def do_PATCH(self): fake._handle(self, "PATCH")
+			def do_DELETE(self): fake._handle(self, "DELETE")
+			def log_message(self, format, *args): pass
+
+		self.server = _ThreadingHTTPServer(("127.0.0.1", port), Handler)
+		threading.Thread(target=self.server.serve_forever, name="fake-kube-server", daemon=True).start()
+		threading.Thread(target=self._run_timers, name="fake-kube-lifecycle", daemon=True).start()
+		return self
+
+	def stop(self):
+		with self.lock:
+			self.stopped = True
+			self.lock.notify_all()
+		if self.server is not None:
+			self.server.shutdown()
+			self.server.server_close()
+
+	def install(self):
+		# Points the API client at the fake, in-cluster configuration then
+		# becomes a no-op so that unmodified controller code can be used
+		kubernetes.client.configuration.host = self.url
+		kubernetes.client.configuration.api_key = {}
+		kubernetes.config.load_incluster_config = lambda *args, **kwargs: None
+
+	def reset_counters(self):
+		with self.lock:
+			self.api_calls = collections.Counter()
+
+	def counters(self):
+		with self.lock:
+			return dict(self.api_calls)
+
+	# Object store, all methods below expect the lock to be held
+
+	def _emit(self, kind, etype, object):
+		self.resource_version += 1
+		object["metadata"]["resourceVersion"] = str(self.resource_version)
+		self.events[kind].append((self.resource_version, etype, json.loads(json.dumps(object))))
+		self.event_versions[kind].append(self.resource_version)
+		self.lock.notify_all()
+
+	def _events_after(self, kind, resource_version):
+		return self.events[kind][bisect.bisect_right(self.event_versions[kind], resource_version):]
+
+	def _schedule(self, delay, func, *args):
+		heapq.heappush(self.timers, (time.time() + delay, next(self.timer_seq), func, args))
+		self.lock.notify_all()
+
+	def _run_timers(self):
+		with self.lock:
+			while not self.stopped:
+				now = time.time()
+				if self.timers and self.timers[0][0] <= now:
+					(_, _, func, args) = heapq.heappop(self.timers)
+					func(*args)
+				else:
+					self.lock.wait(self.timers[0][0] - now if self.timers else None)
+
+	def _pod_setting(self, pod, key):
+		annotations = pod["metadata"].get("annotations") or {}
+		if "fake-kube/" + key not in annotations:
+			return self.lifecycle[key]
+		value = annotations["fake-kube/" + key]
+		if key == "waiting-reason":
+			return value or None
+		if value in ["", "none", "inf"]:
+			return None
+		return int(value) if key == "exit-code" else float(value)
+
+	def _container_statuses(self, pod, state, ready):
+		return [{"name": c["name"], "image": c.get("image", ""), "imageID": "",
+		         "ready": ready, "restartCount": 0, "state": state}
+		        for c in pod["spec"]["containers"]]
+
+	def _pod_step(self, uid, step):
+		pod = self.objects["pods"].get(uid)
+		if pod is None or (pod["metadata"].get("deletionTimestamp") and step != "gone"):
+			return
+		if step == "scheduled":
+			pod["spec"]["nodeName"] = "fake-node-%d" % (hash(uid) % 4)
+			pod["status"] = {"phase": "Pending",
+			                 "containerStatuses": self._container_statuses(
+			                     pod, {"waiting": {"reason": "ContainerCreating"}}, False)}
+			self._emit("pods", "MODIFIED", pod)
+			waiting_reason = self._pod_setting(pod, "waiting-reason")
+			if waiting_reason is not None:
+				self._schedule(self._pod_setting(pod, "start"), self._pod_waiting, uid, waiting_reason)
+			else:
+				self._schedule(self._pod_setting(pod, "start"), self._pod_step, uid, "running")
+		elif step == "running":
+			pod["status"] = {"phase": "Running", "podIP": "10.0.0.%d" % (hash(uid) % 250 + 1),
+			                 "containerStatuses": self._container_statuses(
+			                     pod, {"running": {"startedAt": _timestamp()}}, True)}
+			self._emit("pods", "MODIFIED", pod)
+			run = self._pod_setting(pod, "run")
+			if run is not None:
+				self._schedule(run, self._pod_step, uid, "terminated")
+		elif step == "terminated":
+			exit_code = self._pod_setting(pod, "exit-code")
+			state = {"terminated": {"exitCode": exit_code, "reason": "Completed" if exit_code == 0 else "Error",
+			                        "startedAt": _timestamp(), "finishedAt": _timestamp()}}
+			pod["status"] = {"phase": "Succeeded" if exit_code == 0 else "Failed",
+			                 "podIP": pod["status"].get("podIP"),
+			                 "containerStatuses": self._container_statuses(pod, state, False)}
+			self._emit("pods", "MODIFIED", pod)
+		elif step == "gone":
+			del self.objects["pods"][uid]
+			self._emit("pods", "DELETED", pod)
+
+	def _pod_waiting(self, uid, reason):
+		pod = self.objects["pods"].get(uid)
+		if pod is None or pod["metadata"].get("deletionTimestamp"):
+			return
+		pod["status"]["containerStatuses"] = self._container_statuses(pod, {"waiting": {"reason": reason}}, False)
+		self._emit("pods", "MODIFIED", pod)
+
+	def _create(self, kind, namespace, body):
+		if namespace is not None:
+			body["metadata"]["namespace"] = namespace
+		uid = (namespace, body["metadata"]["name"])
+		if uid in self.objects[kind]:
+			return (409, self._status(409, "AlreadyExists", "%s %s already exists" % (kind, uid[1])))
+		body["kind"] = KINDS[kind]
+		body["metadata"]["uid"] = "%s-%d" % (kind, self.resource_version + 1)
+		body["metadata"]["creationTimestamp"] = _timestamp()
+		if kind == "pods":
+			body["status"] = {"phase": "Pending"}
+		self.objects[kind][uid] = body
+		self._emit(kind, "ADDED", body)
+		if kind == "pods":
+			self._schedule(self._pod_setting(body, "schedule"), self._pod_step, uid, "scheduled")
+		return (201, body)
+
+	def _delete(self, kind, uid):
+		object = self.objects[kind].get(uid)
+		if object is None:
+			return False
+		if kind == "pods":
+			if not object["metadata"].get("deletionTimestamp"):
+				object["metadata"]["deletionTimestamp"] = _timestamp()
+				self._emit(kind, "MODIFIED", object)
+				self._schedule(self._pod_setting(object, "terminate"), self._pod_step, uid, "gone")
+		else:
+			del self.objects[kind][uid]
+			self._emit(kind, "DELETED", object)
+		return True
+
+	def _patch(self, kind, uid, operations):
+		object = self.objects[kind][uid]
+		for op in operations:
+			keys = [k.replace("~1", "/").replace("~0", "~") for k in op["path"].split("/")[1:]]
+			parent = object
+			for key in keys[:-1]:
+				parent = parent.setdefault(key, {})
+			if op["op"] in ["add", "replace"]:
+				parent[keys[-1]] = op["value"]
+			elif op["op"] == "remove":
+				parent.pop(keys[-1], None)
+			else:
+				return (422, self._status(422, "Invalid", "Unsupported patch operation %s" % op["op"]))
+		self._emit(kind, "MODIFIED", object)
+		return (200, object)
+
+	def _list(self, kind, namespace, selector):
+		items = [o for o in self.objects[kind].values() if _matches(o, namespace, selector)]
+		return {"kind": KINDS[kind] + "List", "apiVersion": "v1",
+		        "metadata": {"resourceVersion": str(self.resource_version)}, "items": items}
+
+	@staticmethod
+	def _status(code, reason, message):
+		return {"kind": "Status", "apiVersion": "v1", "metadata": {},
+		        "status": "Failure" if code >= 400 else "Success",
+		        "reason": reason, "message": message, "code": code}
+
+	# HTTP handling
+
+	def _send(self, handler, code, body):
+		data = json.dumps(body).encode('utf-8')
+		handler.send_response(code)
+		handler.send_header("Content-Type", "application/json")
+		handler.send_header("Content-Length", str(len(data)))
+		handler.end_headers()
+		handler.wfile.write(data)
+
+	def _sleep(self, verb):
+		latency = self.latency.get(verb, 0.0)
+		if latency > 0:
+			time.sleep(latency * (1.0 + self.jitter * self.rng.random()))
+
+	def _handle(self, handler, method):
+		url = urlparse(handler.path)
+		query = {k: v[0] for (k, v) in parse_qs(url.query).items()}
+		body = None
+		length = int(handler.headers.get("Content-Length") or 0)
+		if length > 0:
+			body = json.loads(handler.rfile.read(length).decode('utf-8'))
+
+		m = PATH_RE.match(url.path)
+		if m is None or m.group(4) not in KINDS:
+			self._send(handler, 404, self._status(404, "NotFound", "No such path %s" % url.path))
+			return
+		namespace = m.group(3)
+		kind = m.group(4)
+		name = m.group(6)
+		selector = _parse_selector(query.get("labelSelector"))
+		if kind == "namespaces":
+			namespace = None
+
+		if method == "GET" and m.group(7):
+			verb = "log"
+		elif method == "GET" and name is not None:
+			verb = "get"
+		elif method == "GET":
+			verb = "watch" if query.get("watch") in ["true", "True", "1"] else "list"
+		elif method == "POST":
+			verb = "create"
+		elif method == "PATCH":
+			verb = "patch"
+		elif name is not None:
+			verb = "delete"
+		else:
+			verb = "deletecollection"
+
+		with self.lock:
+			self.api_calls["%s %s" % (verb, kind)] += 1
+		self._sleep(verb)
+
+		if verb == "watch":
+			self._watch(handler, kind, namespace, selector, query)
+			return
+
+		with self.lock:
+			if verb == "create":
+				(code, result) = self._create(kind, namespace, body)
+			elif verb == "list":
+				(code, result) = (200, self._list(kind, namespace, selector))
+			elif verb == "deletecollection":
+				for uid in [uid for (uid, o) in self.objects[kind].items() if _matches(o, namespace, selector)]:
+					self._delete(kind, uid)
+				(code, result) = (200, self._status(200, "", ""))
+			else:
+				object = self.objects[kind].get((namespace, name))
+				if object is None:
+					(code, result) = (404, self._status(404, "NotFound", "%s %s not found" % (kind, name)))
+				elif verb == "get":
+					(code, result) = (200, object)
+				elif verb == "patch":
+					(code, result) = self._patch(kind, (namespace, name), body)
+				elif verb == "delete":
+					self._delete(kind, (namespace, name))
+					(code, result) = (200, self._status(200, "", ""))
+				else:
+					(code, result) = (200, None)
+
+		if verb == "log" and code == 200:
+			line = ("%s fake log line of container %s\n" % (_timestamp(), query.get("container", ""))).encode('utf-8')
+			data = (line * (self.log_size // len(line) + 1))[:self.log_size]
+			handler.send_response(200)
+			handler.send_header("Content-Type", "text/plain")
+			handler.send_header("Content-Length", str(len(data)))
+			handler.end_headers()
+			handler.wfile.write(data)
+		else:
+			self._send(handler, code, result)
+
+	def _watch(self, handler, kind, namespace, selector, query):
+		# Streams events after the given resource version as chunked JSON
+		# lines until the timeout expired or the fake is stopped
+		deadline = time.time() + float(query.get("timeoutSeconds", 300))
+		with self.lock:
+			last = int(query.get("resourceVersion") or self.resource_version)
+		handler.send_response(200)
+		handler.send_header("Content-Type", "application/json")
+		handler.send_header("Transfer-Encoding", "chunked")
+		handler.end_headers()
+		try:
+			while True:
+				with self.lock:
+					events = self._events_after(kind, last)
+					while not events and not self.stopped and time.time() < deadline:
+						self.lock.wait(deadline - time.time())
+						events = self._events_after(kind, last)
+					if not events:
+						break
+				for (rv, etype, object) in events:
+					last = rv
+					if _matches(object, namespace, selector):
+						data = (json.dumps({"type": etype, "object": object}) + "\n").encode('utf-8')
+						handler.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+				handler.wfile.flush()
+			handler.wfile.write(b"0\r\n\r\n")
+		except (BrokenPipeError, ConnectionResetError):
+			pass
@@ -0,0 +1,201 @@
+
+from kubernetes.client.rest import ApiException
+
+import hashlib
+import json
+import time
+
+# Container images of a tournament are pulled onto all nodes ahead of the
+# games by a DaemonSet with one init container per image. The init
+# containers exit immediately, a pause container keeps the pods around
+# so that the DaemonSet reports them as ready once all images are pulled.
+# The pulled images need not contain a shell or any other binary, a first
+# init container copies a static no-op binary from NOOP_IMAGE to a shared
+# volume, which the pull containers run instead of the image's own
+# commands.
+
+PREPULL_LABEL = "rcll-sim-prepull"
+# JSON list of the images the DaemonSet pulls
+IMAGES_ANNOTATION = "rcll-sim/prepull-images"
+# Hash of the pod template, the DaemonSet is only replaced if it changed
+SPEC_ANNOTATION = "rcll-sim/prepull-spec"
+PAUSE_IMAGE = "gcr.io/google_containers/pause-amd64:3.0"
+# Busybox is linked statically, its true applet runs in any image
+NOOP_IMAGE = "busybox:1.28"
+NOOP_DIR = "/rcll-sim-prepull"
+
+def normalize_image(image):
+	# Fully qualified image reference, e.g., "mongo:3.4" becomes
+	# "docker.io/library/mongo:3.4", so that references from manifests can
+	# be compared to the image names reported by the nodes
+	parts = image.split("/")
+	if len(parts) == 1 or not ("." in parts[0] or ":" in parts[0] or parts[0] == "localhost"):
+		if len(parts) == 1:
+			parts = ["library"] + parts
+		parts = ["docker.io"] + parts
+	if "@" not in parts[-1] and ":" not in parts[-1]:
+		parts[-1] += ":latest"
+	return "/".join(parts)
+
+def collect_images(manifests):
+	# Returns the images, image pull secrets, and tolerations of all pods
+	# among the given manifests
+	images = set()
+	pull_secrets = set()
+	tolerations = {}
+	for manifest in manifests:
+		if manifest["kind"] != "Pod":
+			continue
+		spec = manifest["spec"]
+		for c in (spec.get("initContainers") or []) + spec["containers"]:
+			images.add(c["image"])
+		for s in spec.get("imagePullSecrets") or []:
+			pull_secrets.add(s["name"])
+		for t in spec.get("tolerations") or []:
+			tolerations[json.dumps(t, sort_keys=True)] = t
+	return (images, pull_secrets, list(tolerations.values()))
+
+def tournament_images(wq, podctrl, tournament, namespace, state="pending"):
+	# Renders the templates of all jobs of the tournament in the given state
+	# and collects the images etc. as collect_images. Jobs sharing their
+	# parameters are only rendered once. Returns the collected images, pull
+	# secrets, and tolerations and the number of rendered parameter sets.
+	images = set()
+	pull_secrets = set()
+	tolerations = {}
+	param_sets = 0
+	for job in wq.distinct_params(tournament=tournament, state=state):
+		templates = []
+		for i in wq.job_params(job)["template_parameters"]:
+			vars = dict(i.get("vars") or {}, namespace=namespace, job_name=job["name"])
+			templates.append((i["template"], vars, i.get("sufficient_containers", [])))
+		(rv, entries) = podctrl.render_templates(templates)
+		(job_images, job_secrets, job_tolerations) = collect_images([e[0] for e in entries])
+		images |= job_images
+		pull_secrets |= job_secrets
+		for t in job_tolerations:
+			tolerations[json.dumps(t, sort_keys=True)] = t
+		param_sets += 1
+	return (sorted(images), sorted(pull_secrets), list(tolerations.values()), param_sets)
+
+def daemonset_manifest(name, images, pull_secrets=[], tolerations=[], pause_image=PAUSE_IMAGE,
+                       noop_image=NOOP_IMAGE):
+	init_containers = [{"name": name, "image": image,
+	                    "imagePullPolicy": "IfNotPresent",
+	                    "command": command,
+	                    "volumeMounts": [{"name": "noop", "mountPath": NOOP_DIR}],
+	                    "resources": {"requests": {"cpu": "10m", "memory": "16Mi"}}}
+	                   for (name, image, command) in \
+	                       [("install-noop", noop_image, ["cp", "/bin/true", NOOP_DIR + "/true"])] + \
+	                       [("pull-%d" % i, image, [NOOP_DIR + "/true"]) for (i, image) in enumerate(images)]]
+	template = {
+		"metadata": {"labels": {PREPULL_LABEL: name}},
+		"spec": {
+			"initContainers": init_containers,
+			"containers": [{"name": "pause", "image": pause_image,
+			                "resources": {"requests": {"cpu": "1m", "memory": "8Mi"}}}],
+			"volumes": [{"name": "noop", "emptyDir": {}}],
+			"imagePullSecrets": [{"name": s} for s in pull_secrets],
+			"tolerations": tolerations,
+			"terminationGracePeriodSeconds": 0
+		}
+	}
+	spec_hash = hashlib.sha1(json.dumps(template, sort_keys=True).encode('utf-8')).hexdigest()
+	return {
+		"apiVersion": "extensions/v1beta1",
+		"kind": "DaemonSet",
+		"metadata": {
+			"name": name,
+			"labels": {PREPULL_LABEL: name},
+			"annotations": {IMAGES_ANNOTATION: json.dumps(images),
+			                SPEC_ANNOTATION: spec_hash}
+		},
+		"spec": {
+			"selector": {"matchLabels": {PREPULL_LABEL: name}},
+			# Images are pulled on all nodes at the same time
+			"updateStrategy": {"type": "RollingUpdate",
+			                   "rollingUpdate": {"maxUnavailable": "100%"}},
+			"template": template
+		}
+	}
+
+def read_daemonset(beta1_api, namespace, name):
+	# The DaemonSet, None if it does not exist
+	try:
+		return beta1_api.read_namespaced_daemon_set(name, namespace)
+	except ApiException as e:
+		if e.status == 404:
+			return None
+		raise
+
+def daemonset_images(daemonset):
+	annotations = daemonset.metadata.annotations or {}
+	return json.loads(annotations.get(IMAGES_ANNOTATION, "[]"))
+
+def deploy(beta1_api, namespace, manifest):
+	# Creates or updates the DaemonSet. Returns "created", "updated", or
+	# "unchanged" if its pod template, i.e., the images, pull secrets, and
+	# tolerations, did not change.
+	name = manifest["metadata"]["name"]
+	existing = read_daemonset(beta1_api, namespace, name)
+	if existing is None:
+		beta1_api.create_namespaced_daemon_set(namespace, manifest)
+		return "created"
+	if (existing.metadata.annotations or {}).get(SPEC_ANNOTATION) \
+	   == manifest["metadata"]["annotations"][SPEC_ANNOTATION]:
+		return "unchanged"
+	beta1_api.replace_namespaced_daemon_set(name, namespace, manifest)
+	return "updated"
+
+def daemonset_ready(daemonset):
+	# All pods of the current revision are scheduled and ready, i.e., all
+	# images have been pulled on all nodes
+	status = daemonset.status
+	return (status.observed_generation or 0) >= (daemonset.metadata.generation or 0) and \
+	       (status.updated_number_scheduled or 0) == status.desired_number_scheduled and \
+	       (status.number_ready or 0) == status.desired_number_scheduled
+
+def wait_ready(beta1_api, namespace, name, timeout, poll_interval=5, progress=True):
+	# Waits for the DaemonSet to become ready, returns False on timeout and
+	# None if the DaemonSet does not exist
+	deadline = time.time() + timeout
+	last_status = None
+	while True:
+		daemonset = read_daemonset(beta1_api, namespace, name)
+		if daemonset is None:
+			return None
+		if daemonset_ready(daemonset):
+			return True
+		status = (daemonset.status.number_ready or 0, daemonset.status.desired_number_scheduled)
+		if progress and status != last_status:
+			print("  - image pre-pull %s/%s: %d of %d nodes ready" % ((namespace, name) + status))
+			last_status = status
+		if time.time() >= deadline:
+			return False
+		time.sleep(poll_interval)
+
+def node_coverage(core_api, images):
+	# Returns (node name, cached images, missing images) for all schedulable
+	# nodes. Note that nodes only report their largest images (50 by
+	# default, cf. kubelet --node-status-max-images), images beyond that
+	# appear as missing.
+	wanted = {normalize_image(i): i for i in images}
+	coverage = []
+	for node in core_api.list_node().items:
+		if node.spec.unschedulable:
+			continue
+		cached = set()
+		for node_image in node.status.images or []:
+			for n in node_image.names or []:
+				cached.add(normalize_image(n))
+		coverage.append((node.metadata.name,
+		                 sorted([i for (n, i) in wanted.items() if n in cached]),
+		                 sorted([i for (n, i) in wanted.items() if n not in cached])))
+	return sorted(coverage)
+
+def print_coverage(coverage, indent=""):
+	for (node, cached, missing) in coverage:
+		total = len(cached) + len(missing)
+		print("%s%-24s %3d/%d images cached%s" \
+		      % (indent, node, len(cached), total,
+		         (" (missing: %s)" % ", ".join(missing)) if missing else ""))
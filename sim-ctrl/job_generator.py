@@ -1,5 +1,5 @@
 
-from work_queue import WorkQueue
+from work_queue import WorkQueue, ID_SORT
 from config import Configuration
 from pprint import pprint
 from difflib import unified_diff
@@ -8,10 +8,70 @@ import jinja2
 import random
 import os
 import yaml
+import copy
+import hashlib
 import datetime
 
+class RenderCache(object):
+	# Caches rendered and parsed parameter documents. Entries are keyed by
+	# the content hash of the template tree and the template variables.
+	# Team templates (team-<name>.j2) only contribute to the key of
+	# pairings they take part in, so that editing a team template only
+	# invalidates the entries of that team.
+	def __init__(self, template_dir):
+		self.template_dir = template_dir
+		self.file_hashes = {}
+		self.results = {}
+		self.hits = 0
+		self.misses = 0
+
+	def _file_hash(self, filename):
+		path = os.path.join(self.template_dir, filename)
+		st = os.stat(path)
+		cached = self.file_hashes.get(filename)
+		if cached is not None and cached[0] == (st.st_mtime_ns, st.st_size):
+			return cached[1]
+		with open(path, 'rb') as f:
+			digest = hashlib.sha1(f.read()).hexdigest()
+		self.file_hashes[filename] = ((st.st_mtime_ns, st.st_size), digest)
+		return digest
+
+	def _base_hash(self):
+		h = hashlib.sha1()
+		for filename in sorted(os.listdir(self.template_dir)):
+			if filename.startswith("team-") or \
+			   not os.path.isfile(os.path.join(self.template_dir, filename)):
+				continue
+			h.update(filename.encode('utf-8'))
+			h.update(self._file_hash(filename).encode('ascii'))
+		return h.hexdigest()
+
+	def _team_hash(self, team_name):
+		filename = "team-%s.j2" % team_name
+		if not os.path.isfile(os.path.join(self.template_dir, filename)):
+			return None
+		return self._file_hash(filename)
+
+	def key(self, template_file, param_vars):
+		return (template_file, self._base_hash(),
+		        param_vars["tournament_name"],
+		        param_vars["team_name_cyan"], self._team_hash(param_vars["team_name_cyan"]),
+		        param_vars["team_name_magenta"], self._team_hash(param_vars["team_name_magenta"]))
+
+	def get(self, key):
+		if key in self.results:
+			self.hits += 1
+			(yamldoc, parameters) = self.results[key]
+			# callers may modify the parameters, hand out a private copy
+			return (yamldoc, copy.deepcopy(parameters))
+		self.misses += 1
+		return None
+
+	def put(self, key, yamldoc, parameters):
+		self.results[key] = (yamldoc, copy.deepcopy(parameters))
+
 class JobGenerator(object):
-	def __init__(self, template, debug=False, dry_run=False):
+	def __init__(self, template, debug=False, dry_run=False, cache_renders=True):
 		self.config = Configuration()
 		self.debug = debug
 		self.dry_run = dry_run
@@ -33,9 +93,15 @@ class JobGenerator(object):
 		if self.template_file == "":
 			raise Exception("Template must be a file, not a directory")
 
+		# Compiled templates are kept in a persistent bytecode cache, so that
+		# subsequent invocations of the tools need not re-compile them
 		self.jinja = jinja2.Environment(loader=jinja2.FileSystemLoader(self.template_dir),
+		                                bytecode_cache=jinja2.FileSystemBytecodeCache(
+		                                    self.config.template_cache_dir),
 		                                autoescape=False)
 
+		self.render_cache = RenderCache(self.template_dir) if cache_renders else None
+
 	def _generate_random_id(self, team_cyan, team_magenta, suffix_length=8):
 		return team_cyan + "-vs-" + team_magenta + ":" + \
 			''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(suffix_length))
@@ -57,21 +123,7 @@ class JobGenerator(object):
 			"team_name_cyan": team_cyan,
 			"team_name_magenta": team_magenta or ""
 		}
-		template = self.jinja.get_template(self.template_file)
-		if template is None:
-			print("Failed to get template '%s' (in '%s')" % (self.template_file, self.template_dir))
-			raise FileNotFoundError("Could not find template '%s' ( in '%s')" \
-			                        % (template_name, self.template_dir))
-
-		yamldoc = template.render(param_vars)
-		if self.debug: print("YAML:\n%s" % yamldoc)
-
-		try:
-			(tournament_doc, parameter_doc) = yaml.load_all(yamldoc)
-		except:
-			for idx, line in enumerate(yamldoc.splitlines()):
-				print("%-4d: %s" % (idx, line))
-			raise
+		(yamldoc, parameters) = self.render(param_vars)
 
 		#if self.debug:
 			#print("Tournament:\n")
@@ -88,7 +140,7 @@ class JobGenerator(object):
 		params = {
 			"parameter_vars": param_vars,
 			"parameter_doc_yaml": yamldoc,
-			"template_parameters": parameter_doc["parameters"]
+			"template_parameters": parameters
 		}
 		#if self.debug:
 			#print("Job Parameters")
@@ -96,6 +148,34 @@ class JobGenerator(object):
 
 		return (jobname, idnum, params)
 
+	def render(self, param_vars):
+		cache_key = None
+		if self.render_cache is not None:
+			cache_key = self.render_cache.key(self.template_file, param_vars)
+			cached = self.render_cache.get(cache_key)
+			if cached is not None:
+				return cached
+
+		template = self.jinja.get_template(self.template_file)
+		if template is None:
+			print("Failed to get template '%s' (in '%s')" % (self.template_file, self.template_dir))
+			raise FileNotFoundError("Could not find template '%s' ( in '%s')" \
+			                        % (self.template_file, self.template_dir))
+
+		yamldoc = template.render(param_vars)
+		if self.debug: print("YAML:\n%s" % yamldoc)
+
+		try:
+			(tournament_doc, parameter_doc) = yaml.load_all(yamldoc)
+		except:
+			for idx, line in enumerate(yamldoc.splitlines()):
+				print("%-4d: %s" % (idx, line))
+			raise
+
+		if cache_key is not None:
+			self.render_cache.put(cache_key, yamldoc, parameter_doc["parameters"])
+		return (yamldoc, parameter_doc["parameters"])
+
 	def store(self, jobname, idnum, params):
 		if not self.dry_run:
 			self.wq.add_item(jobname, idnum, params)
@@ -105,43 +185,96 @@ class JobGenerator(object):
 		self.store(jobname, idnum, params)
 		return (jobname, idnum, params)
 
-	def update_params(self, tournament_name, print_diffs=False, only_pending=True):
-		for i in self.wq.get_items(JobGenerator.id_regex(tournament_name)):
-			if only_pending and i['status']['state'] != 'pending': continue
+	def generate_and_store_many(self, tournament_name, pairings, batch_size=500):
+		# Bulk version of generate_and_store. Reserves IDs for all pairings
+		# in a single round trip and stores generated jobs in batches.
+		# Yields a tuple (pairing, jobname, idnum, params, error) per pairing,
+		# error is None if the job was generated and stored successfully.
+		pairings = list(pairings)
+		if not pairings: return
+		first_id = 1 if self.dry_run else self.wq.get_next_ids(len(pairings))
+
+		batch = []
+		for i, (team_cyan, team_magenta) in enumerate(pairings):
+			idnum = 1 if self.dry_run else first_id + i
+			try:
+				(jobname, idnum, params) = \
+				    self.generate(tournament_name, team_cyan, team_magenta, job_num=idnum)
+				batch.append(((team_cyan, team_magenta), jobname, idnum, params))
+			except Exception as e:
+				yield ((team_cyan, team_magenta), None, idnum, None, e)
+
+			if len(batch) >= batch_size or i == len(pairings) - 1:
+				failed = {}
+				if not self.dry_run:
+					failed = self.wq.add_items([(jobname, idnum, params)
+					                            for (_, jobname, idnum, params) in batch],
+					                           batch_size=batch_size)
+				for (pairing, jobname, idnum, params) in batch:
+					error = None
+					if jobname in failed:
+						error = Exception("Failed to store job %s: %s" % (jobname, failed[jobname]))
+					yield (pairing, jobname, idnum, params, error)
+				batch = []
 
-			job_parts = i['name'].split(':')
+	def update_params(self, tournament_name, print_diffs=False, only_pending=True, batch_size=500):
+		# Re-renders the parameters of the jobs of a tournament and updates
+		# jobs whose parameter document hash changed. All jobs of a pairing
+		# share the same parameters, hence each pairing is rendered once.
+		renders = {}
+		updates = []
+		num_unchanged = 0
+		for i in self.wq.find_items("status", tournament=tournament_name,
+		                            state="pending" if only_pending else None, sort=ID_SORT):
+			job_parts = i.name.split(':')
 			teams = job_parts[2].split("-vs-")
-			(jobname, idnum, params) = \
-			    self.generate(job_parts[0], teams[0], teams[1], job_num=int(job_parts[1]))
-			if jobname != i['name']:
+			jobname = self._generate_id(job_parts[0], teams[0], teams[1], int(job_parts[1]))
+			if jobname != i.name:
 				raise Exception("Invalid jobname, expected '%s', got '%s'" %
-					                (i['name'], jobname))
-			diff = unified_diff(i["params"]["parameter_doc_yaml"].splitlines(True),
-			                    params['parameter_doc_yaml'].splitlines(True),
-			                    fromfile='%s OLD' % jobname, tofile='%s' % jobname)
-			diffstr = ''.join(diff)
-			if print_diffs:
-				if len(diffstr) == 0:
+					                (i.name, jobname))
+
+			pairing = (job_parts[0], teams[0], teams[1])
+			if pairing not in renders:
+				(_, _, params) = self.generate(job_parts[0], teams[0], teams[1], job_num=int(job_parts[1]))
+				renders[pairing] = (params, WorkQueue.params_hash(params), None)
+			(params, params_hash, stored_params) = renders[pairing]
+
+			if i.params_hash == params_hash:
+				num_unchanged += 1
+				if print_diffs:
 					print("%s: no update required" % jobname)
-				else:
-					print(diffstr)
-
-			if not self.dry_run and len(diffstr) > 0:
-				update={"$push": { "updates": { "updated": datetime.datetime.utcnow(),
-				                                "diff": diffstr }},
-				        "$set": {"status.state": "pending", "params": params},
-				        "$unset": { "manifests": "", "status.completed": "",
-				                    "status.running": ""}
-				}
-				if self.debug: pprint(update)
-				self.wq.update_item(jobname, update)
+				continue
+
+			record = { "updated": datetime.datetime.utcnow(), "params_hash": params_hash }
+			if print_diffs:
+				old = self.wq.job_params(self.wq.get_specific_item(jobname))
+				diff = unified_diff(old["parameter_doc_yaml"].splitlines(True),
+				                    params['parameter_doc_yaml'].splitlines(True),
+				                    fromfile='%s OLD' % jobname, tofile='%s' % jobname)
+				record["diff"] = ''.join(diff)
+				print(record["diff"])
+
+			# The parameter document of a pairing is stored once, when the
+			# first of its jobs needs an update
+			if stored_params is None:
+				stored_params = self.wq.store_params(params) if not self.dry_run else params
+				renders[pairing] = (params, params_hash, stored_params)
+			update={"$push": { "updates": record },
+			        "$set": {"status.state": "pending", "params": stored_params, "params_hash": params_hash},
+			        "$unset": { "manifest_blobs": "", "status.completed": "",
+			                    "status.running": ""}
+			}
+			if self.debug: pprint(update)
+			before = (i.state, i.num_failed > 0)
+			updates.append((jobname, before, update))
+
+		num_updated = 0
+		if not self.dry_run and updates:
+			num_updated = self.wq.update_items(updates, batch_size=batch_size)
+		print("%d jobs changed (%d updated), %d unchanged, %d pairings rendered" \
+		      % (len(updates), num_updated, num_unchanged, len(renders)))
 
 	def cancel_jobs(self, tournament_name, only_pending = True):
-		update = {"$set": { "status.state": "cancelled",
-		                    "status.cancelled": datetime.datetime.utcnow()}}
-		for i in self.wq.get_items(JobGenerator.id_regex(tournament_name)):
-			if i['status']['state'] != 'cancelled' and \
-			   (not only_pending or i['status']['state'] == 'pending'):
-				print("Cancelling %s" % i['name'])
-				if not self.dry_run:
-					self.wq.update_item(i['name'], update)
+		num_cancelled = self.wq.cancel_items(tournament_name, only_pending=only_pending,
+		                                     dry_run=self.dry_run)
+		print("Cancelled %d jobs" % num_cancelled)
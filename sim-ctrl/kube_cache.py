@@ -0,0 +1,218 @@
+from kubernetes.watch import Watch
+from kubernetes.client.rest import ApiException
+
+import threading
+import queue
+import time
+import asyncio
+import traceback
+
+# Informer-style cache of Kubernetes objects of one kind in one namespace.
+# A single background thread lists the objects once and then keeps
+# watching, resuming from the last seen resourceVersion after the watch
+# times out or is disconnected. It only falls back to a full LIST if the
+# API server reports the resource version as expired. Consumers query the
+# in-memory cache or subscribe to the event stream instead of opening
+# their own watches. With namespace None, objects of all namespaces are
+# watched, typically restricted by a label selector, so that a single
+# watch serves the job namespaces of several game slots.
+
+class Subscription(object):
+	def __init__(self, informer, snapshot, loop=None):
+		self.informer = informer
+		# Objects known at the time of subscription, all later changes
+		# are delivered as events. Taken atomically, no event is lost.
+		self.snapshot = snapshot
+		# With an event loop, events are consumed with get() from within
+		# the loop instead of blocking a thread in events()
+		self.loop = loop
+		self.queue = asyncio.Queue() if loop is not None else queue.Queue()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def close(self):
+		self.informer.unsubscribe(self)
+
+	def put(self, event):
+		# called from the informer thread
+		if self.loop is not None:
+			self.loop.call_soon_threadsafe(self.queue.put_nowait, event)
+		else:
+			self.queue.put(event)
+
+	async def get(self):
+		return await self.queue.get()
+
+	def events(self, timeout=None, idle=False):
+		# Yields events in the same format as kubernetes.watch.Watch.stream,
+		# i.e., dicts with 'type' and 'object'. Without timeout, this waits
+		# for events forever. Waiting is done in short steps to keep
+		# signal handlers responsive. If idle is set, an IDLE event without
+		# object is yielded after each step without events, so that
+		# consumers can do periodic work.
+		deadline = None if timeout is None else time.time() + timeout
+		while True:
+			wait = 1.0
+			if deadline is not None:
+				remaining = deadline - time.time()
+				if remaining <= 0: return
+				wait = min(wait, remaining)
+			try:
+				yield self.queue.get(timeout=wait)
+			except queue.Empty:
+				if idle:
+					yield {"type": "IDLE", "object": None}
+
+class Informer(object):
+	def __init__(self, list_func, namespace, watch_timeout=300, label_selector=None):
+		self.list_func = list_func
+		self.namespace = namespace
+		self.watch_timeout = watch_timeout
+		self.list_args = [namespace] if namespace is not None else []
+		self.list_kwargs = {}
+		if label_selector is not None:
+			self.list_kwargs["label_selector"] = label_selector
+		self.objects = {}
+		self.resource_version = None
+		self.subscribers = []
+		self.lock = threading.Lock()
+		self.synced = threading.Event()
+		self.stopped = False
+		self.watch = None
+		self.thread = threading.Thread(target=self._run, daemon=True,
+		                               name="informer-%s-%s" % (namespace or "all", list_func.__name__))
+		self.thread.start()
+
+	@staticmethod
+	def _key(object):
+		return (object.metadata.namespace, object.metadata.name)
+
+	def stop(self):
+		self.stopped = True
+		if self.watch is not None:
+			self.watch.stop()
+
+	def wait_synced(self, timeout=None):
+		if not self.synced.wait(timeout):
+			raise Exception("Cache for %s in namespace %s did not sync" %
+			                (self.list_func.__name__, self.namespace))
+
+	def get(self, namespace, name):
+		self.wait_synced()
+		with self.lock:
+			return self.objects.get((namespace, name))
+
+	def list(self):
+		self.wait_synced()
+		with self.lock:
+			return list(self.objects.values())
+
+	def subscribe(self, loop=None):
+		self.wait_synced()
+		with self.lock:
+			sub = Subscription(self, list(self.objects.values()), loop)
+			self.subscribers.append(sub)
+		return sub
+
+	def unsubscribe(self, sub):
+		with self.lock:
+			if sub in self.subscribers:
+				self.subscribers.remove(sub)
+
+	def _notify(self, events):
+		# must be called with lock held to keep order with subscribe()
+		for sub in self.subscribers:
+			for event in events:
+				sub.put(event)
+
+	def _relist(self):
+		res = self.list_func(*self.list_args, **self.list_kwargs)
+		with self.lock:
+			current = {Informer._key(o): o for o in res.items}
+			# Emit the changes missed while not watching
+			events = []
+			for (key, object) in current.items():
+				if key not in self.objects:
+					events.append({"type": "ADDED", "object": object})
+				elif self.objects[key].metadata.resource_version != object.metadata.resource_version:
+					events.append({"type": "MODIFIED", "object": object})
+			for (key, object) in self.objects.items():
+				if key not in current:
+					events.append({"type": "DELETED", "object": object})
+			self.objects = current
+			self.resource_version = res.metadata.resource_version
+			self._notify(events)
+		self.synced.set()
+
+	def _run(self):
+		while not self.stopped:
+			try:
+				if self.resource_version is None:
+					self._relist()
+
+				self.watch = Watch()
+				for event in self.watch.stream(self.list_func, *self.list_args,
+				                               resource_version=self.resource_version,
+				                               timeout_seconds=self.watch_timeout,
+				                               **self.list_kwargs):
+					if event['type'] == "ERROR":
+						# Typically 410 Gone, our resource version is too old
+						self.resource_version = None
+						self.watch.stop()
+						break
+					object = event['object']
+					key = Informer._key(object)
+					with self.lock:
+						if event['type'] == "DELETED":
+							self.objects.pop(key, None)
+						else:
+							self.objects[key] = object
+						self.resource_version = object.metadata.resource_version
+						self._notify([event])
+
+			except ApiException as e:
+				if e.status == 410:
+					self.resource_version = None
+				else:
+					print("Watching %s failed, retrying: %s" % (self.list_func.__name__, str(e)))
+					time.sleep(1)
+			except Exception:
+				if not self.stopped:
+					print("Watching %s failed, retrying" % self.list_func.__name__)
+					print(traceback.format_exc())
+					time.sleep(1)
+
+class InformerSet(object):
+	# Informers for pods and services, created on first use and shared by
+	# all users of the set
+	def __init__(self, core_api, namespace=None, label_selector=None):
+		self.core_api = core_api
+		self.namespace = namespace
+		self.label_selector = label_selector
+		self.informers = {}
+		self.lock = threading.Lock()
+
+	def informer(self, kind):
+		with self.lock:
+			if kind not in self.informers:
+				if kind == "pods":
+					list_func = self.core_api.list_namespaced_pod if self.namespace is not None \
+					            else self.core_api.list_pod_for_all_namespaces
+				elif kind == "services":
+					list_func = self.core_api.list_namespaced_service if self.namespace is not None \
+					            else self.core_api.list_service_for_all_namespaces
+				else:
+					raise ValueError("No informer for kind '%s'" % kind)
+				self.informers[kind] = Informer(list_func, self.namespace,
+				                                label_selector=self.label_selector)
+			return self.informers[kind]
+
+	def stop(self):
+		with self.lock:
+			for informer in self.informers.values():
+				informer.stop()
+			self.informers = {}
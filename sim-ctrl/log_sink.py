@@ -0,0 +1,188 @@
+from datetime import datetime
+
+import os
+import gzip
+import json
+import zlib
+
+# Log sinks store retained container logs of a job. A sink hands out one
+# job logs object per job (DirectoryJobLogs, S3JobLogs), whose open()
+# returns the key and a stream for a container log and whose finish()
+# finally writes a manifest describing all stored logs of the job.
+# Streams compress the data they are given themselves, callers write the
+# raw log data. A stream is either closed once all data has been written
+# or aborted, which discards what has been written so far.
+
+def job_dir_name(job_name, time=None):
+	time_str = (time or datetime.now()).strftime("%Y%m%d-%H%M")
+	return "%s-%s" % (job_name.replace(":", "_"), time_str)
+
+class JobLogs(object):
+	# Bookkeeping of the stored logs shared by the job logs classes
+	def __init__(self, job_name, location):
+		self.job_name = job_name
+		self.location = location
+		self.entries = []
+
+	def add_entry(self, pod_name, container, key, size, stored_size, duration):
+		self.entries.append({ "pod": pod_name, "container": container, "key": key,
+		                      "bytes": size, "stored_bytes": stored_size,
+		                      "duration": duration })
+
+	def manifest(self, summary=None):
+		return {
+			"job_name": self.job_name,
+			"location": self.location,
+			"created": datetime.utcnow().isoformat() + "Z",
+			"logs": sorted(self.entries, key=lambda e: (e["pod"], e["container"])),
+			"summary": summary or {},
+		}
+
+class FileLogStream(object):
+	def __init__(self, filename, compress=True):
+		self.filename = filename
+		self.file = (gzip.open if compress else open)(filename, 'wb')
+
+	def write(self, data):
+		self.file.write(data)
+
+	def close(self):
+		self.file.close()
+		return os.path.getsize(self.filename)
+
+	def abort(self):
+		self.file.close()
+		os.remove(self.filename)
+
+class DirectoryJobLogs(JobLogs):
+	def __init__(self, output_dir, job_name=None, compress=True):
+		JobLogs.__init__(self, job_name or os.path.basename(output_dir), output_dir)
+		self.output_dir = output_dir
+		self.compress = compress
+
+	def open(self, pod_name, container):
+		output_poddir = os.path.join(self.output_dir, pod_name)
+		os.makedirs(output_poddir, exist_ok=True)
+		filename = os.path.join(output_poddir, "%s.log%s" % (container, ".gz" if self.compress else ""))
+		return (os.path.relpath(filename, self.output_dir), FileLogStream(filename, self.compress))
+
+	def finish(self, summary=None):
+		with open(os.path.join(self.output_dir, "manifest.json"), 'w') as f:
+			json.dump(self.manifest(summary), f, indent=2)
+
+class FilesystemLogSink(object):
+	def __init__(self, basedir, compress=True):
+		self.basedir = basedir
+		self.compress = compress
+
+	def check(self):
+		if self.basedir is None or self.basedir == "":
+			raise Exception("Logs basedir must be set if retaining logs is enabled")
+		if not os.path.isdir(self.basedir):
+			raise Exception("Logs basedir is not a directory")
+		if not os.access(self.basedir, os.W_OK):
+			raise Exception("Cannot write to logs basedir")
+
+	def job(self, job_name):
+		output_dir = os.path.normpath(os.path.join(self.basedir, job_dir_name(job_name)))
+		os.makedirs(output_dir)
+		return DirectoryJobLogs(output_dir, job_name, self.compress)
+
+class S3LogStream(object):
+	# Compresses data on the fly and uploads it as a multipart upload,
+	# nothing is staged on disk. All parts but the last must be at least
+	# 5 MiB in size.
+	def __init__(self, client, bucket, key, part_size):
+		self.client = client
+		self.bucket = bucket
+		self.key = key
+		self.part_size = part_size
+		self.compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+		self.buffer = bytearray()
+		self.parts = []
+		self.stored_size = 0
+		res = self.client.create_multipart_upload(Bucket=bucket, Key=key,
+		                                          ContentType="application/gzip")
+		self.upload_id = res["UploadId"]
+
+	def _upload_part(self):
+		part_number = len(self.parts) + 1
+		res = self.client.upload_part(Bucket=self.bucket, Key=self.key,
+		                              PartNumber=part_number, UploadId=self.upload_id,
+		                              Body=bytes(self.buffer))
+		self.parts.append({ "PartNumber": part_number, "ETag": res["ETag"] })
+		self.stored_size += len(self.buffer)
+		self.buffer = bytearray()
+
+	def write(self, data):
+		self.buffer += self.compressor.compress(data)
+		if len(self.buffer) >= self.part_size:
+			self._upload_part()
+
+	def close(self):
+		self.buffer += self.compressor.flush()
+		# An upload needs at least one part, even if it is empty
+		if self.buffer or not self.parts:
+			self._upload_part()
+		self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key,
+		                                      UploadId=self.upload_id,
+		                                      MultipartUpload={ "Parts": self.parts })
+		return self.stored_size
+
+	def abort(self):
+		self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key,
+		                                   UploadId=self.upload_id)
+
+class S3JobLogs(JobLogs):
+	def __init__(self, sink, job_name, prefix):
+		JobLogs.__init__(self, job_name, "s3://%s/%s" % (sink.bucket, prefix))
+		self.sink = sink
+		self.prefix = prefix
+
+	def open(self, pod_name, container):
+		key = "%s%s/%s.log.gz" % (self.prefix, pod_name, container)
+		return (key, S3LogStream(self.sink.client, self.sink.bucket, key, self.sink.part_size))
+
+	def finish(self, summary=None):
+		body = json.dumps(self.manifest(summary), indent=2).encode('utf-8')
+		self.sink.client.put_object(Bucket=self.sink.bucket, Key=self.prefix + "manifest.json",
+		                            Body=body, ContentType="application/json")
+
+class S3LogSink(object):
+	# Stores logs in an S3 compatible object store, e.g., the Ceph RGW.
+	# The endpoint may point to any S3 compatible service, e.g., a local
+	# stand-in for testing.
+	def __init__(self, endpoint_url, bucket, access_key=None, secret_key=None,
+	             prefix="", part_size=8*1024*1024):
+		# Only required if the S3 sink is used
+		import boto3
+
+		if part_size < 5*1024*1024:
+			raise ValueError("S3 multipart uploads require parts of at least 5 MiB")
+		self.endpoint_url = endpoint_url
+		self.bucket = bucket
+		self.prefix = prefix
+		if self.prefix and not self.prefix.endswith("/"):
+			self.prefix += "/"
+		self.part_size = part_size
+		self.client = boto3.client("s3", endpoint_url=endpoint_url,
+		                           aws_access_key_id=access_key,
+		                           aws_secret_access_key=secret_key)
+
+	def check(self):
+		# Throws if the bucket does not exist or is not accessible
+		self.client.head_bucket(Bucket=self.bucket)
+
+	def job(self, job_name):
+		return S3JobLogs(self, job_name, self.prefix + job_dir_name(job_name) + "/")
+
+def create_log_sink(config):
+	if config.log_sink == "s3":
+		return S3LogSink(config.logs_s3_endpoint, config.logs_s3_bucket,
+		                 access_key=config.logs_s3_access_key,
+		                 secret_key=config.logs_s3_secret_key,
+		                 prefix=config.logs_s3_prefix or "")
+	elif config.log_sink == "filesystem":
+		return FilesystemLogSink(config.logs_basedir)
+	else:
+		raise ValueError("Unknown log sink '%s'" % config.log_sink)
@@ -0,0 +1,67 @@
+
+import contextlib
+import threading
+import time
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+# Prometheus instrumentation of the controller. The metrics are served on
+# /metrics by prometheus_client.start_http_server.
+
+# Buckets in seconds for job phases, which range from sub-second claims
+# to games lasting tens of minutes
+PHASE_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 900, 1200, 1800, 3600]
+# Buckets in seconds for single API requests
+REQUEST_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+JOB_PHASE_SECONDS = Histogram("rcll_sim_job_phase_seconds",
+                              "Duration of the phases of simulation jobs",
+                              ["phase", "tournament", "template"], buckets=PHASE_BUCKETS)
+JOBS_FINISHED = Counter("rcll_sim_jobs_finished_total",
+                        "Number of jobs run to completion or failure",
+                        ["tournament", "template", "result"])
+CLAIM_SECONDS = Histogram("rcll_sim_claim_seconds",
+                          "Latency of claiming a job from the work queue",
+                          ["tournament", "result"], buckets=REQUEST_BUCKETS)
+QUEUE_DEPTH = Gauge("rcll_sim_queue_depth",
+                    "Number of pending jobs as last seen by the controller",
+                    ["tournament", "jobs"])
+KUBE_API_SECONDS = Histogram("rcll_sim_kube_api_seconds",
+                             "Latency of Kubernetes API requests",
+                             ["method", "path"], buckets=REQUEST_BUCKETS)
+KUBE_API_ERRORS = Counter("rcll_sim_kube_api_errors_total",
+                          "Number of failed Kubernetes API requests",
+                          ["method", "path"])
+
+class PhaseTimer(object):
+	# Durations in seconds of the phases of one job. Each phase is also
+	# observed in the phase histogram with the tournament and template
+	# labels of the job. Phases may be recorded from several threads, e.g.,
+	# the teardown runs in the background.
+	def __init__(self, tournament, template):
+		self.labels = {"tournament": tournament or "", "template": template or ""}
+		self.durations = {}
+		self.lock = threading.Lock()
+
+	def observe(self, phase, seconds):
+		with self.lock:
+			self.durations[phase] = self.durations.get(phase, 0.0) + seconds
+		JOB_PHASE_SECONDS.labels(phase=phase, **self.labels).observe(seconds)
+
+	@contextlib.contextmanager
+	def phase(self, phase):
+		start = time.time()
+		try:
+			yield
+		finally:
+			self.observe(phase, time.time() - start)
+
+	def get(self, phase):
+		with self.lock:
+			return self.durations.get(phase)
+
+	def finished(self, result):
+		JOBS_FINISHED.labels(result=result, **self.labels).inc()
+
+	def as_dict(self):
+		with self.lock:
+			return dict(self.durations)
@@ -1,32 +1,152 @@
 
 import kubernetes
 from kubernetes.client import V1Container, V1DeleteOptions, V1ObjectMeta, V1Pod, V1PodSpec
-from kubernetes.watch import Watch
 from kubernetes.client.rest import ApiException
 from kubernetes.client.api_client import ApiClient
 
+from kube_cache import Informer
+from log_sink import DirectoryJobLogs
+import metrics
+
 import jinja2
 import yaml
 import json
+import re
+import hashlib
+import itertools
+import copy
 from datetime import datetime, timedelta
 import traceback
 import requests
-import gzip
 import sys
 import os
 import humanize
-
-PROGRESS_BAR_WIDTH = 25
+import threading
+import queue
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+# Log downloads are received in large chunks, up to LOG_QUEUE_SIZE chunks
+# are buffered per container while waiting for compression
+LOG_CHUNK_SIZE = 1024 * 1024
+LOG_QUEUE_SIZE = 8
+# Handed to the log writer instead of the final None if receiving the log
+# failed, the incomplete log is then discarded
+LOG_ABORT = object()
+
+# Manifests are created in tiers by ascending number. Resources within a
+# tier are independent of each other and are created concurrently.
+CREATION_TIERS = {
+	"Role": 0,
+	"RoleBinding": 0,
+	"ServiceAccount": 0,
+	"ConfigMap": 0,
+	"Service": 1,
+	"Ingress": 1,
+	"Pod": 2,
+}
+
+# Label attached to all resources created for a job, used for teardown
+JOB_LABEL = "rcll-sim-job"
+
+# Keys of the resource bookkeeping by manifest kind
+RESOURCE_KEYS = {
+	"Pod": "pods",
+	"Service": "services",
+	"Ingress": "ingress",
+	"ConfigMap": "config_maps",
+	"Role": "roles",
+	"RoleBinding": "role_bindings",
+	"ServiceAccount": "service_accounts",
+}
+
+# Non-pod resources (roles, services, config maps) annotated with
+# REUSABLE_ANNOTATION: "true" may be kept for the next job of a controller
+# (cf. keep_environment) and are only recreated if their manifest changed.
+# The annotation is ignored on pods.
+REUSABLE_ANNOTATION = "rcll-sim/reusable"
+
+# Container waiting reasons from which a pod does not recover on its own,
+# the job fails immediately. ErrImagePull is not included, it is reported
+# on the first failed pull, which may be transient, and is followed by
+# ImagePullBackOff if pulling keeps failing.
+TERMINAL_WAITING_REASONS = ["ImagePullBackOff", "ErrImageNeverPull", "InvalidImageName",
+                            "CrashLoopBackOff", "CreateContainerConfigError",
+                            "CreateContainerError", "RunContainerError"]
+
+# While monitoring, deadlines are checked at least this often (seconds)
+WATCHDOG_INTERVAL = 5
+
+def job_label_value(job_name):
+	# Label values are restricted to 63 alphanumeric, '-', '_' or '.'
+	# characters, job names contain colons and may be longer.
+	value = re.sub(r'[^A-Za-z0-9_.-]', '.', job_name)
+	if len(value) > 63:
+		value = value[:22] + "-" + hashlib.sha1(job_name.encode('utf-8')).hexdigest()[:40]
+	return value.strip("-_.")
+
+def manifest_hash(manifest):
+	# Content hash of a manifest ignoring the job label. Manifests which
+	# mention the job name differ between jobs and are never reused.
+	manifest = copy.deepcopy(manifest)
+	labels = manifest["metadata"].get("labels") or {}
+	labels.pop(JOB_LABEL, None)
+	if not labels:
+		manifest["metadata"].pop("labels", None)
+	return hashlib.sha1(json.dumps(manifest, sort_keys=True).encode('utf-8')).hexdigest()
+
+class TimedApiClient(ApiClient):
+	# API client which records the latency of every request, labelled by
+	# method and path template, e.g., POST /api/v1/namespaces/{namespace}/pods.
+	# For watches, this is the time until the response headers arrived.
+	def call_api(self, resource_path, method, *args, **kwargs):
+		start_time = time.time()
+		try:
+			return ApiClient.call_api(self, resource_path, method, *args, **kwargs)
+		except:
+			metrics.KUBE_API_ERRORS.labels(method=method, path=resource_path).inc()
+			raise
+		finally:
+			metrics.KUBE_API_SECONDS.labels(method=method, path=resource_path).observe(time.time() - start_time)
 
 class PodController(object):
-	def __init__(self, config, namespace="default"):
+	def __init__(self, config, namespace="default", api_client=None, informers=None):
+		# Several controllers may share an API client and an InformerSet,
+		# otherwise each controller has its own watches for its namespace
 		self.namespace = namespace
-		kubernetes.config.load_incluster_config()
+		if api_client is None:
+			kubernetes.config.load_incluster_config()
+			api_client = TimedApiClient()
 		self.kube_config = kubernetes.client.configuration
-		self.core_api = kubernetes.client.CoreV1Api()
-		self.beta1_api = kubernetes.client.ExtensionsV1beta1Api()
-		self.rbac_api = kubernetes.client.RbacAuthorizationV1beta1Api()
-		self.resources = {
+		self.core_api = kubernetes.client.CoreV1Api(api_client)
+		self.beta1_api = kubernetes.client.ExtensionsV1beta1Api(api_client)
+		self.rbac_api = kubernetes.client.RbacAuthorizationV1beta1Api(api_client)
+		self.resources = PodController._empty_resources()
+		self.resources_lock = threading.Lock()
+		self.job_label = None
+		self.timer = None
+		# Resources kept from the previous job for reuse, maps (kind,
+		# namespace, name) to the manifest hash and bookkeeping entry
+		self.environment = {}
+		# Why monitoring considered the current job failed, if it did
+		self.failure_reason = None
+		self.cleanups = []
+		self.shared_informers = informers
+		self.informers = {}
+		self.informers_lock = threading.Lock()
+		self.executor = ThreadPoolExecutor(max_workers=int(config.kube_api_workers))
+		self.log_workers = int(config.log_download_workers)
+		self.log_executor = ThreadPoolExecutor(max_workers=self.log_workers)
+		self.log_session = None
+		self.log_session_lock = threading.Lock()
+
+		self.jinja = jinja2.Environment(loader=jinja2.FileSystemLoader(config.template_path),
+										autoescape=False, extensions=['jinja2.ext.with_'])
+
+	@staticmethod
+	def _empty_resources():
+		return {
 			"pods": {},
 			"services": {},
 			"ingress": {},
@@ -36,119 +156,210 @@ class PodController(object):
 			"service_accounts": {},
 		}
 
-		self.jinja = jinja2.Environment(loader=jinja2.FileSystemLoader(config.template_path),
-										autoescape=False, extensions=['jinja2.ext.with_'])
+	def begin_job(self, job_name, timer=None):
+		# Resources created from now on are labelled as belonging to the job.
+		# If given, the metrics.PhaseTimer of the job receives the time until
+		# all pods are up and the teardown time.
+		self.job_label = job_label_value(job_name)
+		self.timer = timer
+		self.failure_reason = None
+
+	def informer(self, kind):
+		# One shared list+watch per kind for the job namespace
+		if self.shared_informers is not None:
+			return self.shared_informers.informer(kind)
+		with self.informers_lock:
+			if kind not in self.informers:
+				if kind == "pods":
+					list_func = self.core_api.list_namespaced_pod
+				elif kind == "services":
+					list_func = self.core_api.list_namespaced_service
+				else:
+					raise ValueError("No informer for kind '%s'" % kind)
+				self.informers[kind] = Informer(list_func, self.namespace)
+			return self.informers[kind]
+
+	def close(self):
+		with self.informers_lock:
+			for informer in self.informers.values():
+				informer.stop()
+			self.informers = {}
 
 	def wait_pod_event(self, name, cond):
-		w = Watch()
-		for event in w.stream(self.core_api.list_namespaced_pod, self.namespace, timeout_seconds=120):
-			object = event['object']
-			etype = event['type']
-			if object.metadata.name != name: continue
-			if cond(etype, object):
-				w.stop()
+		with self.informer("pods").subscribe() as sub:
+			for event in sub.events(timeout=120):
+				object = event['object']
+				etype = event['type']
+				if object.metadata.name != name: continue
+				if cond(etype, object):
+					break
 
 	def _pod_completed_cond(etype, object):
 		return (etype == "MODIFIED" and
 				(object.status.phase == "Succeeded" or object.status.phase == "Failed"))
 
-	def create_from_template(self, template_name, vars, sufficient_containers=[]):
+	def render_template(self, template_name, vars):
 		template = self.jinja.get_template(template_name + ".yaml.j2")
 		if template is None:
 			print("Failed to get template '%s'" % template_name)
 			raise FileNotFoundError("Could not find template '%s'" % template_name)
 
-		rv = []
-		
 		yamldoc = template.render(vars)
-		rv.append(("YAML", template_name, yamldoc))
 		try:
-			manifests = yaml.load_all(yamldoc)
+			manifests = [m for m in yaml.load_all(yamldoc) if m is not None]
 		except:
 			print("Inflicting YAML doc:\n%s" % yamldoc)
 			raise
 
 		for manifest in manifests:
-			if manifest["kind"] == "Pod":
-				#print("Creating Pod '%s'" % manifest["metadata"]["name"])
-				s = manifest["metadata"]["name"] + " (" \
-				    + ",".join(["{}{}".format("*" if c["name"] in sufficient_containers else "", c["name"])
-				                for c in manifest["spec"]["containers"]]) \
-				    + ")"
-				print("    - %s: %s" % (manifest["kind"], s))
-				try:
-					self.create_pod(manifest, sufficient_containers=sufficient_containers)
-				except:
-					print("Inflicting YAML doc:\n%s" % yamldoc)
-					raise
-				rv.append((manifest["kind"], s, manifest))
+			if manifest["kind"] not in CREATION_TIERS:
+				raise ValueError("Unsupported manifest kind '%s'" % manifest["kind"])
 
-			elif manifest["kind"] == "Service":
-				#print("Creating Service '%s'" % manifest["metadata"]["name"])
-				print("    - %s: %s" % (manifest["kind"], manifest["metadata"]["name"]))
-				try:
-					self.create_service(manifest)
-				except:
-					print("Inflicting YAML doc:\n%s" % yamldoc)
-					raise
-				rv.append((manifest["kind"], manifest["metadata"]["name"], manifest))
+		return (yamldoc, manifests)
 
-			elif manifest["kind"] == "Ingress":
-				#print("Creating Ingress '%s'" % manifest["metadata"]["name"])
-				print("    - %s: %s" % (manifest["kind"], manifest["metadata"]["name"]))
-				try:
-					self.create_ingress(manifest)
-				except:
-					print("Inflicting YAML doc:\n%s" % yamldoc)
-					raise
-				rv.append((manifest["kind"], manifest["metadata"]["name"], manifest))
+	def create_from_template(self, template_name, vars, sufficient_containers=[]):
+		return self.create_from_templates([(template_name, vars, sufficient_containers)])
 
-			elif manifest["kind"] == "ConfigMap":
-				#print("Creating ConfigMap '%s'" % manifest["metadata"]["name"])
-				print("    - %s: %s" % (manifest["kind"], manifest["metadata"]["name"]))
-				try:
-					self.create_config_map(manifest)
-				except:
-					print("Inflicting YAML doc:\n%s" % yamldoc)
-					raise
-				rv.append((manifest["kind"], manifest["metadata"]["name"], manifest))
+	def create_from_templates(self, templates):
+		return self.create_rendered(self.render_templates(templates))
 
-			elif manifest["kind"] == "Role":
-				print("    - %s: %s" % (manifest["kind"], manifest["metadata"]["name"]))
+	def render_templates(self, templates):
+		# Render all templates given as (template_name, vars, sufficient_containers)
+		# tuples. The result can be passed to create_rendered at a later time.
+		rv = []
+		entries = []
+		for (template_name, vars, sufficient_containers) in templates:
+			(yamldoc, manifests) = self.render_template(template_name, vars)
+			rv.append(("YAML", template_name, yamldoc))
+			for manifest in manifests:
+				if manifest["kind"] == "Pod":
+					desc = manifest["metadata"]["name"] + " (" \
+					       + ",".join(["{}{}".format("*" if c["name"] in sufficient_containers else "", c["name"])
+					                   for c in manifest["spec"]["containers"]]) \
+					       + ")"
+				else:
+					desc = manifest["metadata"]["name"]
+				entries.append((manifest, desc, sufficient_containers, yamldoc))
+		return (rv, entries)
+
+	def create_rendered(self, rendered):
+		# Create manifests as returned by render_templates tier by tier.
+		# Manifests within a tier do not depend on each other and are created
+		# concurrently, a tier is only started once the previous one succeeded.
+		(rv, entries) = rendered
+		rv = list(rv)
+		entries = self._reuse_environment(entries, rv)
+		for tier in sorted(set(CREATION_TIERS.values())):
+			tier_entries = [e for e in entries if CREATION_TIERS[e[0]["kind"]] == tier]
+			futures = []
+			for (manifest, desc, sufficient_containers, yamldoc) in tier_entries:
+				print("    - %s: %s" % (manifest["kind"], desc))
+				futures.append(self.executor.submit(self._create_manifest, manifest, sufficient_containers))
+
+			errors = []
+			for (entry, future) in zip(tier_entries, futures):
 				try:
-					self.create_role(manifest)
-				except:
+					future.result()
+				except Exception as e:
+					errors.append((entry, e))
+
+			if errors:
+				inflicting_docs = []
+				for (entry, e) in errors:
+					if entry[3] not in inflicting_docs:
+						inflicting_docs.append(entry[3])
+				for yamldoc in inflicting_docs:
 					print("Inflicting YAML doc:\n%s" % yamldoc)
-					raise
-				rv.append((manifest["kind"], manifest["metadata"]["name"], manifest))
+				raise Exception("Failed to create %s" %
+				                ", ".join(["%s %s (%s)" % (entry[0]["kind"], entry[1], str(e))
+				                           for (entry, e) in errors]))
 
-			elif manifest["kind"] == "RoleBinding":
-				print("    - %s: %s" % (manifest["kind"], manifest["metadata"]["name"]))
-				try:
-					self.create_role_binding(manifest)
-				except:
-					print("Inflicting YAML doc:\n%s" % yamldoc)
-					raise
-				rv.append((manifest["kind"], manifest["metadata"]["name"], manifest))
+			for (manifest, desc, sufficient_containers, yamldoc) in tier_entries:
+				rv.append((manifest["kind"], desc, manifest))
 
+		return rv
+
+	def _reuse_environment(self, entries, rv):
+		# Keeps the resources left by the previous job whose manifests did not
+		# change and deletes all others, their names may be used by the new
+		# resources. Returns the entries which remain to be created.
+		environment = self.environment
+		self.environment = {}
+		if not environment:
+			return entries
+		create = []
+		candidates = {}
+		for entry in entries:
+			(manifest, desc, sufficient_containers, yamldoc) = entry
+			key = (RESOURCE_KEYS[manifest["kind"]],
+			       manifest["metadata"]["namespace"], manifest["metadata"]["name"])
+			if self.job_label is None or key not in environment or \
+			   environment[key]["hash"] != manifest_hash(manifest):
+				create.append(entry)
 			else:
-				raise ValueError("Unsupported manifest kind '%s'" % manifest["kind"])
+				candidates[key] = entry
+
+		errors = self._relabel_all(candidates.keys(), self.job_label)
+		reused = set()
+		for (key, entry) in candidates.items():
+			(manifest, desc, sufficient_containers, yamldoc) = entry
+			if key in errors:
+				print("Failed to reuse %s %s:%s, recreating it (%s)" % (key + (errors[key],)))
+				create.append(entry)
+				continue
+			print("    - %s: %s (reused)" % (manifest["kind"], desc))
+			self._label_manifest(manifest)
+			with self.resources_lock:
+				self.resources[key[0]][key[1:]] = { "phase": "Requested", "manifest": manifest }
+			del environment[key]
+			reused.add(key)
+			rv.append((manifest["kind"], desc, manifest))
+
+		if environment:
+			print("    - deleting %d changed or unused resources of the previous job" % len(environment))
+			self._delete_resources(self._environment_resources(environment),
+			                       self._environment_label(), False, keep=reused)
+		return create
+
+	def _label_manifest(self, manifest):
+		if self.job_label is not None:
+			if not manifest["metadata"].get("labels"):
+				manifest["metadata"]["labels"] = {}
+			manifest["metadata"]["labels"][JOB_LABEL] = self.job_label
+
+	def _create_manifest(self, manifest, sufficient_containers=[]):
+		kind = manifest["kind"]
+		self._label_manifest(manifest)
+		if kind == "Pod":
+			self.create_pod(manifest, sufficient_containers=sufficient_containers)
+		elif kind == "Service":
+			self.create_service(manifest)
+		elif kind == "Ingress":
+			self.create_ingress(manifest)
+		elif kind == "ConfigMap":
+			self.create_config_map(manifest)
+		elif kind == "Role":
+			self.create_role(manifest)
+		elif kind == "RoleBinding":
+			self.create_role_binding(manifest)
+		elif kind == "ServiceAccount":
+			self.create_service_account(manifest)
+		else:
+			raise ValueError("Unsupported manifest kind '%s'" % kind)
 
-			#print("%s\n\n" % str(manifest))
-		return rv
-	
 	def create_pod(self, manifest, sufficient_containers=[]):
 		try:
 			res = self.core_api.create_namespaced_pod(namespace=manifest["metadata"]["namespace"],
 													  body=manifest)
-			self.resources["pods"][(manifest["metadata"]["namespace"], manifest["metadata"]["name"])] = \
-				{ "phase": "Requested",
-				  "status": "Requested",
-				  "manifest": manifest,
-				  "sufficient_containers": sufficient_containers,
-				  "total": 0,
-				  "ready": 0,
-				}
+			with self.resources_lock:
+				self.resources["pods"][(manifest["metadata"]["namespace"], manifest["metadata"]["name"])] = \
+					{ "phase": "Requested",
+					  "status": "Requested",
+					  "manifest": manifest,
+					  "sufficient_containers": sufficient_containers,
+					  "total": 0,
+					  "ready": 0,
+					}
 		except ApiException as e:
 			print("Failed to create pod %s/%s: '%s'" % (manifest["metadata"]["namespace"],
 														manifest["metadata"]["name"], e))
@@ -158,8 +369,9 @@ class PodController(object):
 		try:
 			res = self.core_api.create_namespaced_service(namespace=manifest["metadata"]["namespace"],
 														  body=manifest)
-			self.resources["services"][(manifest["metadata"]["namespace"], manifest["metadata"]["name"])] = \
-				{ "phase": "Requested", "manifest": manifest }
+			with self.resources_lock:
+				self.resources["services"][(manifest["metadata"]["namespace"], manifest["metadata"]["name"])] = \
+					{ "phase": "Requested", "manifest": manifest }
 		except ApiException as e:
 			print("Failed to create service %s/%s: '%s'" % (manifest["metadata"]["namespace"],
 														manifest["metadata"]["name"], e))
@@ -169,8 +381,9 @@ class PodController(object):
 		try:
 			res = self.beta1_api.create_namespaced_ingress(namespace=manifest["metadata"]["namespace"],
 			                                               body=manifest)
-			self.resources["ingress"][(manifest["metadata"]["namespace"], manifest["metadata"]["name"])] = \
-				{ "phase": "Requested", "manifest": manifest }
+			with self.resources_lock:
+				self.resources["ingress"][(manifest["metadata"]["namespace"], manifest["metadata"]["name"])] = \
+					{ "phase": "Requested", "manifest": manifest }
 		except ApiException as e:
 			print("Failed to create ingress %s/%s: '%s'" % (manifest["metadata"]["namespace"],
 			                                                manifest["metadata"]["name"], e))
@@ -180,8 +393,9 @@ class PodController(object):
 		try:
 			res = self.core_api.create_namespaced_config_map(namespace=manifest["metadata"]["namespace"],
 			                                                 body=manifest)
-			self.resources["config_maps"][(manifest["metadata"]["namespace"], manifest["metadata"]["name"])] = \
-				{ "phase": "Requested", "manifest": manifest }
+			with self.resources_lock:
+				self.resources["config_maps"][(manifest["metadata"]["namespace"], manifest["metadata"]["name"])] = \
+					{ "phase": "Requested", "manifest": manifest }
 		except ApiException as e:
 			print("Failed to create config map %s/%s: '%s'" % (manifest["metadata"]["namespace"],
 			                                                   manifest["metadata"]["name"], e))
@@ -191,8 +405,9 @@ class PodController(object):
 		try:
 			res = self.rbac_api.create_namespaced_role(namespace=manifest["metadata"]["namespace"],
 			                                           body=manifest)
-			self.resources["roles"][(manifest["metadata"]["namespace"], manifest["metadata"]["name"])] = \
-				{ "phase": "Requested", "manifest": manifest }
+			with self.resources_lock:
+				self.resources["roles"][(manifest["metadata"]["namespace"], manifest["metadata"]["name"])] = \
+					{ "phase": "Requested", "manifest": manifest }
 		except ApiException as e:
 			print("Failed to create role %s/%s: '%s'" % (manifest["metadata"]["namespace"],
 			                                             manifest["metadata"]["name"], e))
@@ -202,8 +417,9 @@ class PodController(object):
 		try:
 			res = self.rbac_api.create_namespaced_role_binding(namespace=manifest["metadata"]["namespace"],
 			                                                   body=manifest)
-			self.resources["role_bindings"][(manifest["metadata"]["namespace"], manifest["metadata"]["name"])] = \
-				{ "phase": "Requested", "manifest": manifest }
+			with self.resources_lock:
+				self.resources["role_bindings"][(manifest["metadata"]["namespace"], manifest["metadata"]["name"])] = \
+					{ "phase": "Requested", "manifest": manifest }
 		except ApiException as e:
 			print("Failed to create role binding %s/%s: '%s'" % (manifest["metadata"]["namespace"],
 			                                                     manifest["metadata"]["name"], e))
@@ -213,29 +429,118 @@ class PodController(object):
 		try:
 			res = self.core_api.create_namespaced_service_account(namespace=manifest["metadata"]["namespace"],
 			                                                      body=manifest)
-			self.resources["service_accounts"][(manifest["metadata"]["namespace"],
-			                                    manifest["metadata"]["name"])] = \
-				{ "phase": "Requested", "manifest": manifest }
+			with self.resources_lock:
+				self.resources["service_accounts"][(manifest["metadata"]["namespace"],
+				                                    manifest["metadata"]["name"])] = \
+					{ "phase": "Requested", "manifest": manifest }
 		except ApiException as e:
 			print("Failed to create service account %s/%s: '%s'" % (manifest["metadata"]["namespace"],
 			                                                        manifest["metadata"]["name"], e))
 			raise e
 
-	def download_all_pod_logs(self, output_dir, progress=True, compress=True):
+	def _log_session(self):
+		# Shared keep-alive connection pool for all log downloads
+		with self.log_session_lock:
+			if self.log_session is None:
+				session = requests.Session()
+				adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+				                                        pool_maxsize=self.log_workers)
+				session.mount("https://", adapter)
+				session.mount("http://", adapter)
+				session.verify = self.kube_config.ssl_ca_cert
+				self.log_session = session
+			return self.log_session
+
+	def _download_container_log(self, namespace, pod_name, container, job_logs):
+		# Receives the log on the calling thread and hands the chunks over to
+		# a writer thread, which passes them to the log sink stream. The
+		# stream compresses and stores the data.
+		# Returns the tuple (received bytes, stored bytes, duration).
+		start_time = time.time()
+		url = "%s/api/v1/namespaces/%s/pods/%s/log" % \
+		      (self.kube_config.host, namespace, pod_name)
+		headers = {"Authorization": self.kube_config.get_api_key_with_prefix('authorization')}
+		params = {"container": container, "timestamps": True}
+
+		r = self._log_session().get(url, stream=True, headers=headers, params=params)
+		try:
+			try:
+				r.raise_for_status()
+			except:
+				metrics.KUBE_API_ERRORS.labels(method="GET", path="/api/v1/namespaces/{namespace}/pods/{name}/log").inc()
+				raise
+
+			(key, stream) = job_logs.open(pod_name, container)
+			chunks = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+			write_errors = []
+			stored_size = []
+			def write():
+				try:
+					chunk = chunks.get()
+					while chunk is not None and chunk is not LOG_ABORT:
+						stream.write(chunk)
+						chunk = chunks.get()
+					if chunk is LOG_ABORT:
+						stream.abort()
+					else:
+						stored_size.append(stream.close())
+				except Exception as e:
+					write_errors.append(e)
+					try:
+						stream.abort()
+					except Exception:
+						pass
+					# keep consuming to not block the receiving thread
+					while chunk is not None and chunk is not LOG_ABORT: chunk = chunks.get()
+
+			writer = threading.Thread(target=write, name="log-writer-%s-%s" % (pod_name, container))
+			writer.start()
+			size = 0
+			received = False
+			try:
+				for chunk in r.iter_content(chunk_size=LOG_CHUNK_SIZE):
+					if chunk: # filter out keep-alive new chunks
+						size += len(chunk)
+						chunks.put(chunk)
+				received = True
+			finally:
+				# Only a completely received log is stored
+				chunks.put(None if received else LOG_ABORT)
+				writer.join()
+			if write_errors:
+				raise write_errors[0]
+		finally:
+			r.close()
+
+		duration = time.time() - start_time
+		metrics.KUBE_API_SECONDS.labels(method="GET",
+		                                path="/api/v1/namespaces/{namespace}/pods/{name}/log").observe(duration)
+		job_logs.add_entry(pod_name, container, key, size, stored_size[0], duration)
+		return (size, stored_size[0], duration)
+
+	def download_all_pod_logs(self, job_logs, progress=True, compress=True, resources=None):
+		# job_logs is a log sink JobLogs object or the name of an output
+		# directory, in which case logs are stored as files therein
+		if isinstance(job_logs, str):
+			os.makedirs(job_logs, exist_ok=True)
+			job_logs = DirectoryJobLogs(job_logs, compress=compress)
+		if resources is None:
+			resources = self.resources
 
 		# K8s API Server compression is an alpha feature as of 1.9 and disabled by default
 		# (feature gate APIResponseCompression). Therefore, requesting compression is not
 		# enabled here but we rather compress ourselves. Can be added later.
 
-		headers = {"Authorization": self.kube_config.get_api_key_with_prefix('authorization')}
-		params = {"timestamps": True}
-
-		print("Downloading pod logs")
-		for uid in self.resources["pods"]:
+		print("Downloading pod logs to %s" % job_logs.location)
+		start_time = time.time()
+		downloads = []
+		for uid in resources["pods"]:
 			namespace = uid[0]
 			pod_name  = uid[1]
 
-			pod = self.core_api.read_namespaced_pod(pod_name, namespace)
+			pod = self.informer("pods").get(namespace, pod_name)
+			if pod is None and namespace != self.namespace:
+				pod = self.core_api.read_namespaced_pod(pod_name, namespace)
 			if not pod:
 				print("Failed to get info for pod %s:%s" % uid)
 				continue
@@ -243,69 +548,226 @@ class PodController(object):
 			containers = [c.name for c in pod.spec.containers]
 			print("  - Pod %s:%s %s" % (namespace, pod_name, str(containers)))
 
-			output_poddir   = "%s/%s" % (output_dir, pod_name)
-			os.makedirs(output_poddir)
-
 			for container in containers:
-				output_filename = "%s/%s.log.gz" % (output_poddir, container)
-
-				url = "%s/api/v1/namespaces/%s/pods/%s/log" % \
-				      (self.kube_config.host, namespace, pod_name)
+				future = self.log_executor.submit(self._download_container_log,
+				                                  namespace, pod_name, container, job_logs)
+				downloads.append((pod_name, container, future))
 
-				#print("URL: %s" % url)
-				#print("Output: %s" % output_filename)
+		summary = { "containers": 0, "failed": 0, "bytes": 0, "stored_bytes": 0 }
+		for (pod_name, container, future) in downloads:
+			try:
+				(size, stored_size, duration) = future.result()
+				summary["containers"] += 1
+				summary["bytes"] += size
+				summary["stored_bytes"] += stored_size
+				if progress:
+					print("    - %-40s %10s in %.1f s" % ("%s/%s" % (pod_name, container),
+					                                      humanize.naturalsize(size, binary=True), duration))
+			except Exception as e:
+				summary["failed"] += 1
+				print("    - %s/%s failed: %s" % (pod_name, container, str(e)))
+
+		summary["duration"] = time.time() - start_time
+		throughput = summary["bytes"] / summary["duration"] if summary["duration"] > 0 else 0
+		print("Downloaded %d container logs (%d failed), %s (%s stored) in %.1f s, %s/s" \
+		      % (summary["containers"], summary["failed"],
+		         humanize.naturalsize(summary["bytes"], binary=True),
+		         humanize.naturalsize(summary["stored_bytes"], binary=True),
+		         summary["duration"], humanize.naturalsize(throughput, binary=True)))
+		try:
+			job_logs.finish(summary)
+		except Exception as e:
+			print("Failed to write log manifest: %s" % str(e))
+		return summary
+
+	def delete_all(self, background=False, before_delete=None, after_delete=None, keep=()):
+		# Hand over the resources of the current job to the cleanup, so that
+		# the next job can be started while the previous one is drained.
+		# If given, before_delete is called with the resources of the job
+		# prior to deletion, e.g., to retrieve logs, and after_delete once
+		# all resources are gone. Resources in keep are not waited for.
+		resources = self.resources
+		job_label = self.job_label
+		timer = self.timer
+		self.resources = PodController._empty_resources()
+		self.job_label = None
+		self.timer = None
+
+		if background:
+			cleanup = threading.Thread(target=self._delete_resources,
+			                           args=(resources, job_label, False, before_delete,
+			                                 after_delete, timer, keep),
+			                           name="cleanup-%s" % job_label)
+			cleanup.start()
+			self.cleanups.append(cleanup)
+		else:
+			self._delete_resources(resources, job_label, True, before_delete, after_delete, timer, keep)
+
+	def _environment_label(self):
+		# Job label of the resources kept for the next job
+		return job_label_value("%s:environment" % self.namespace)
+
+	@staticmethod
+	def _environment_resources(environment):
+		resources = PodController._empty_resources()
+		for ((kind, namespace, name), kept) in environment.items():
+			resources[kind][(namespace, name)] = kept["entry"]
+		return resources
+
+	def _relabel_all(self, keys, job_label):
+		# Moves the resources given as (kind, namespace, name) to the job
+		# label concurrently. Returns a dict of failed keys to the reason.
+		futures = [(key, self.executor.submit(self._relabel, key[0], key[1:], job_label))
+		           for key in keys]
+		errors = {}
+		for (key, future) in futures:
+			try:
+				future.result()
+			except ApiException as e:
+				errors[key] = e.reason
+		return errors
+
+	def _relabel(self, kind, uid, job_label):
+		patch_funcs = {"services": self.core_api.patch_namespaced_service,
+		               "ingress": self.beta1_api.patch_namespaced_ingress,
+		               "config_maps": self.core_api.patch_namespaced_config_map,
+		               "roles": self.rbac_api.patch_namespaced_role,
+		               "role_bindings": self.rbac_api.patch_namespaced_role_binding,
+		               "service_accounts": self.core_api.patch_namespaced_service_account}
+		patch = [{ "op": "add", "path": "/metadata/labels/%s" % JOB_LABEL, "value": job_label }]
+		patch_funcs[kind](uid[1], uid[0], patch)
+
+	@staticmethod
+	def _reusable(kind, entry):
+		manifest = entry.get("manifest")
+		if kind == "pods" or manifest is None:
+			return False
+		annotations = manifest["metadata"].get("annotations") or {}
+		return annotations.get(REUSABLE_ANNOTATION) == "true"
+
+	def keep_environment(self, background=False, before_delete=None, after_delete=None):
+		# Like delete_all, but reusable non-pod resources (cf.
+		# REUSABLE_ANNOTATION) are moved from the job label to the
+		# environment label, the next create_rendered reuses those with
+		# unchanged manifests. before_delete receives all resources of the
+		# job, including the kept ones.
+		all_resources = {kind: dict(r) for (kind, r) in self.resources.items()}
+		candidates = [(kind,) + uid for (kind, kind_resources) in self.resources.items()
+		              for (uid, entry) in kind_resources.items() if self._reusable(kind, entry)]
+		errors = self._relabel_all(candidates, self._environment_label())
+		for key in candidates:
+			if key in errors:
+				print("Failed to keep %s %s:%s, deleting it (%s)" % (key + (errors[key],)))
+				continue
+			entry = self.resources[key[0]].pop(key[1:])
+			self.environment[key] = {"hash": manifest_hash(entry["manifest"]), "entry": entry}
+		if self.environment:
+			print("Keeping %d resources for the next job" % len(self.environment))
+
+		job_before_delete = before_delete
+		if job_before_delete is not None:
+			def before_delete(resources):
+				job_before_delete(all_resources)
+		self.delete_all(background, before_delete, after_delete, keep=set(self.environment.keys()))
+
+	def discard_environment(self):
+		# Deletes the resources kept for a next job which did not come
+		if not self.environment:
+			return
+		environment = self.environment
+		self.environment = {}
+		print("Deleting %d resources kept for reuse in %s" % (len(environment), self.namespace))
+		self._delete_resources(self._environment_resources(environment), self._environment_label(), True)
+
+	def wait_cleanup(self):
+		# Wait for all background cleanups, required before re-using
+		# resource names in this namespace
+		while self.cleanups:
+			self.cleanups.pop(0).join()
+
+	def _delete_resources(self, resources, job_label, verbose, before_delete=None,
+	                      after_delete=None, timer=None, keep=()):
+		# Resources in keep, given as (kind, namespace, name), have been moved
+		# to another label, which the watch caches may not reflect yet
+		if before_delete is not None:
+			try:
+				before_delete(resources)
+			except:
+				print("Failed to prepare deletion of %s" % job_label)
+				print(traceback.format_exc())
 
-				headers = {"Authorization": self.kube_config.get_api_key_with_prefix('authorization')}
-				params = {"container": container, "timestamps": True}
+		start_time = datetime.now()
+		if verbose: print("Deleting items")
+		if job_label is not None:
+			self._delete_labelled(resources, job_label, verbose, keep)
+		else:
+			self._delete_tracked(resources, verbose)
 
-				r = requests.get(url, stream=True, headers=headers, params=params,
-				                 verify=self.kube_config.ssl_ca_cert)
+		if verbose: print("Waiting for pod and service deletion")
+		self._wait_deleted(resources, "pods", "Pod", self.core_api.read_namespaced_pod, verbose)
+		self._wait_deleted(resources, "services", "Service", self.core_api.read_namespaced_service, verbose)
 
-				with gzip.open(output_filename, 'wb') as f:
-					dl_progress = progress
-					dl = 0
-					last_done = 0
-					total_length = 0
-					cl = r.headers.get('content-length')
-					if cl is not None:
-						total_length = int(cl)
-					else:
-						dl_progress = False
+		all_deleted_time = datetime.now()
+		if timer is not None:
+			timer.observe("teardown", (all_deleted_time-start_time).total_seconds())
+		if verbose:
+			print("All items deleted (deletion took %s)" % str(all_deleted_time-start_time))
+		else:
+			print("Cleanup of %s finished (deletion took %s)" % (job_label, str(all_deleted_time-start_time)))
+
+		if job_label is not None:
+			leaked = self._find_labelled(job_label, keep)
+			for (kind, namespace, name) in leaked:
+				print("  - leaked %s %s:%s" % (kind, namespace, name))
+
+		if after_delete is not None:
+			try:
+				after_delete()
+			except:
+				print("Failed to finish deletion of %s" % job_label)
+				print(traceback.format_exc())
+
+	def _delete_labelled(self, resources, job_label, verbose, keep=()):
+		label_selector = "%s=%s" % (JOB_LABEL, job_label)
+		namespaces = set([self.namespace])
+		for kind_resources in resources.values():
+			namespaces |= set([uid[0] for uid in kind_resources])
+
+		# Also wait for pods and services created for the job but unknown
+		# to the bookkeeping, e.g., after failed creation calls. Resources
+		# kept for the next job may not yet appear relabelled in the cache.
+		for kind in ["pods", "services"]:
+			for o in self.informer(kind).list():
+				if o.metadata.labels and o.metadata.labels.get(JOB_LABEL) == job_label:
+					uid = (o.metadata.namespace, o.metadata.name)
+					if uid not in resources[kind] and (kind,) + uid not in keep:
+						resources[kind][uid] = { "phase": "Unknown" }
+
+		collections = [("Pod", self.core_api.delete_collection_namespaced_pod),
+		               ("Ingress", self.beta1_api.delete_collection_namespaced_ingress),
+		               ("ConfigMap", self.core_api.delete_collection_namespaced_config_map),
+		               ("RoleBinding", self.rbac_api.delete_collection_namespaced_role_binding),
+		               ("Role", self.rbac_api.delete_collection_namespaced_role),
+		               ("ServiceAccount", self.core_api.delete_collection_namespaced_service_account)]
+		for namespace in sorted(namespaces):
+			for (kind, delete_func) in collections:
+				if verbose: print("  - %s %s:%s" % (kind, namespace, label_selector))
+				try:
+					delete_func(namespace, label_selector=label_selector)
+				except:
+					print("    (issue cleaning up %s in %s, ignored)" % (kind, namespace))
 
-					if progress and not dl_progress:
-						sys.stdout.write("    - container %-30s (chunked response)" % container)
-						sys.stdout.flush()
-					else:
-						sys.stdout.write("    - container %-30s" % container)
-						sys.stdout.flush()
-
-					for chunk in r.iter_content(chunk_size=4096):
-						if chunk: # filter out keep-alive new chunks
-							dl += len(chunk)
-							f.write(chunk)
-
-							if dl_progress:
-								done = int(PROGRESS_BAR_WIDTH * dl / total_length)
-								if done > last_done:
-									sys.stdout.write("\r    - %-30s [%s%s] %10s / %-10s" %
-									                 (container,
-									                  '=' * done, ' ' * (PROGRESS_BAR_WIDTH - done),
-									                  humanize.naturalsize(dl, binary=True),
-									                  humanize.naturalsize(total_length, binary=True)))
-									sys.stdout.flush()
-									last_done = done
-
-					if dl_progress:
-						sys.stdout.write("\n")
-					else:
-						sys.stdout.write(" %40s\n" % (humanize.naturalsize(dl, binary=True)))
+		# Services do not support collection deletion
+		for uid in resources["services"]:
+			if verbose: print("  - Service %s:%s" % uid)
+			try:
+				self.core_api.delete_namespaced_service(namespace = uid[0], name = uid[1])
+			except:
+				print("    (issue cleaning up, ignored)")
 
-	def delete_all(self):
-		# We must pass a new default API client to avoid urllib conn pool warnings
-		start_time = datetime.now()
-		print("Deleting items")
-		for uid in self.resources["pods"]:
-			print("  - Pod %s:%s" % uid)
+	def _delete_tracked(self, resources, verbose):
+		for uid in resources["pods"]:
+			if verbose: print("  - Pod %s:%s" % uid)
 			try:
 				res = self.core_api.delete_namespaced_pod(namespace = uid[0],
 				                                          name = uid[1],
@@ -313,256 +775,346 @@ class PodController(object):
 			except:
 				print("    (issue cleaning up, ignored)")
 
-		for uid in self.resources["services"]:
-			print("  - Service %s:%s" % uid)
+		for uid in resources["services"]:
+			if verbose: print("  - Service %s:%s" % uid)
 			try:
 				res = self.core_api.delete_namespaced_service(namespace = uid[0], name = uid[1])
 			except:
 				print("    (issue cleaning up, ignored)")
 
-
-		for uid in self.resources["ingress"]:
-			print("  - Ingress %s:%s" % uid)
+		for uid in resources["ingress"]:
+			if verbose: print("  - Ingress %s:%s" % uid)
 			try:
 				res = self.beta1_api.delete_namespaced_ingress(namespace = uid[0], name = uid[1],
 				                                               body = V1DeleteOptions())
 			except:
 				print("    (issue cleaning up, ignored)")
-		self.resources["ingress"] = {}
 
-		for uid in self.resources["config_maps"]:
-			print("  - ConfigMap %s:%s" % uid)
+		for uid in resources["config_maps"]:
+			if verbose: print("  - ConfigMap %s:%s" % uid)
 			try:
 				res = self.core_api.delete_namespaced_config_map(namespace = uid[0],
 				                                                 name = uid[1],
 				                                                 body = V1DeleteOptions())
 			except:
 				print("    (issue cleaning up, ignored)")
-		self.resources["config_maps"] = {}
 
-		for uid in self.resources["role_bindings"]:
-			print("  - RoleBinding %s:%s" % uid)
+		for uid in resources["role_bindings"]:
+			if verbose: print("  - RoleBinding %s:%s" % uid)
 			try:
 				res = self.rbac_api.delete_namespaced_role_binding(namespace = uid[0],
 				                                                   name = uid[1],
 				                                                   body = V1DeleteOptions())
 			except:
 				print("    (issue cleaning up, ignored)")
-		self.resources["role_bindings"] = {}
 
-		for uid in self.resources["roles"]:
-			print("  - Role %s:%s" % uid)
+		for uid in resources["roles"]:
+			if verbose: print("  - Role %s:%s" % uid)
 			try:
 				res = self.rbac_api.delete_namespaced_role(namespace = uid[0],
 				                                           name = uid[1],
 				                                           body = V1DeleteOptions())
 			except:
 				print("    (issue cleaning up, ignored)")
-		self.resources["roles"] = {}
 
-		for uid in self.resources["service_accounts"]:
-			print("  - ServiceAccount %s:%s" % uid)
+		for uid in resources["service_accounts"]:
+			if verbose: print("  - ServiceAccount %s:%s" % uid)
 			try:
-				res = self.rbac_api.delete_namespaced_service_account(namespace = uid[0],
+				res = self.core_api.delete_namespaced_service_account(namespace = uid[0],
 				                                                      name = uid[1],
 				                                                      body = V1DeleteOptions())
 			except:
 				print("    (issue cleaning up, ignored)")
-		self.resources["service_accounts"] = {}
-
-		# Not checking for possibly deleted pods, pods take a while to
-		# delete and they will not be listed anymore
-
-		print("Waiting for pod and service deletion")
-		#print("Waiting for pods to be deleted: %s" % ', '.join(["%s:%s" % uid for uid in self.resources["pods"]]))
-		while self.resources["pods"]:
-			current_pods = [(i.metadata.namespace, i.metadata.name)
-			                for i in self.core_api.list_namespaced_pod(self.namespace).items]
-			#print("Current pods: %s" % ', '.join(["%s:%s" % uid for uid in current_pods]))
-			deleted_pods = [uid for uid in self.resources["pods"] if uid not in current_pods]
-			#print("Deleted pods: %s" % ', '.join(["%s:%s" % uid for uid in deleted_pods]))
-			for uid in deleted_pods:
-				print("  - Pod %s:%s*" % uid)
-				del self.resources["pods"][uid]
-			if not self.resources["pods"]: break
 
-			#print("Remaining: %s" % ', '.join(["%s:%s" % uid for uid in self.resources["pods"]]))
-			w = Watch()
-			for event in w.stream(self.core_api.list_namespaced_pod, self.namespace,
-			                      timeout_seconds=30):
-				object = event['object']
-				etype = event['type']
-				uid = (object.metadata.namespace, object.metadata.name)
-				if etype == "DELETED" and uid in self.resources["pods"]:
-					print("  - Pod %s:%s" % uid)
-					del self.resources["pods"][uid]
-					if not self.resources["pods"]: w.stop()
-		#print("Done deleting pods")
-
-		#print("Waiting for services to be deleted: %s" % ', '.join(["%s:%s" % uid for uid in self.resources["services"]]))
-		while self.resources["services"]:
-			current_services = [(i.metadata.namespace, i.metadata.name)
-			                    for i in self.core_api.list_namespaced_service(self.namespace).items]
-			#print("Current services: %s" % ', '.join(["%s:%s" % uid for uid in current_services]))
-			deleted_services = [uid for uid in self.resources["services"] if uid not in current_services]
-			#print("Deleted services: %s" % ', '.join(["%s:%s" % uid for uid in deleted_services]))
-			for uid in deleted_services:
-				print("  - Service %s:%s*" % uid)
-				del self.resources["services"][uid]
-			if not self.resources["services"]: break
-
-			# There is a short gap here that could trigger a race condition
-			# but there seems to be no "query and keep watching" API that could
-			# prevent that.
-
-			#print("Remaining: %s" % ', '.join(["%s:%s" % uid for uid in self.resources["services"]]))
-			w = Watch()
-			for event in w.stream(self.core_api.list_namespaced_service, self.namespace,
-			                      timeout_seconds=30):
+	def _find_labelled(self, job_label, keep=()):
+		# Returns (kind, namespace, name) of all resources still carrying the
+		# job label, except for those in keep
+		label_selector = "%s=%s" % (JOB_LABEL, job_label)
+		found = []
+		for kind in ["pods", "services"]:
+			for o in self.informer(kind).list():
+				if o.metadata.labels and o.metadata.labels.get(JOB_LABEL) == job_label and \
+				   (kind, o.metadata.namespace, o.metadata.name) not in keep:
+					found.append((kind, o.metadata.namespace, o.metadata.name))
+		lists = [("ingress", self.beta1_api.list_namespaced_ingress),
+		         ("config_maps", self.core_api.list_namespaced_config_map),
+		         ("role_bindings", self.rbac_api.list_namespaced_role_binding),
+		         ("roles", self.rbac_api.list_namespaced_role),
+		         ("service_accounts", self.core_api.list_namespaced_service_account)]
+		for (kind, list_func) in lists:
+			try:
+				for o in list_func(self.namespace, label_selector=label_selector).items:
+					found.append((kind, o.metadata.namespace, o.metadata.name))
+			except:
+				print("    (failed to check for leaked %s, ignored)" % kind)
+		return found
+
+	def _wait_deleted(self, resources, kind, label, read_func, verbose=True):
+		# Subscribing yields the cached state and all later events atomically,
+		# hence there is no gap in which a deletion could be missed.
+		with self.informer(kind).subscribe() as sub:
+			cached = [Informer._key(o) for o in sub.snapshot]
+			for uid in [uid for uid in resources[kind] if uid not in cached]:
+				# The cache may not yet have seen very recently created
+				# resources, only trust it if the API server agrees.
+				try:
+					read_func(uid[1], uid[0])
+				except ApiException as e:
+					if e.status == 404:
+						if verbose: print("  - %s %s:%s*" % (label, uid[0], uid[1]))
+						del resources[kind][uid]
+
+			if not resources[kind]: return
+			for event in sub.events():
 				object = event['object']
 				etype = event['type']
 				uid = (object.metadata.namespace, object.metadata.name)
-				if etype == "DELETED" and uid in self.resources["services"]:
-					print("  - Service %s:%s" % uid)
-					del self.resources["services"][uid]
-					if not self.resources["services"]: w.stop()
-		#print("Done deleting services")
-
-		all_deleted_time = datetime.now()
-		print("All items deleted (deletion took %s)" % str(all_deleted_time-start_time))
-
-	def monitor_pods(self):
-		# Wrap watch in outer loop, it might get interrupted before we
-		# are finished looking
-		printed_all_up=False
-		start_time = datetime.now()
-		while self.resources["pods"]:
-			try:
-				w = Watch()
-				for event in w.stream(self.core_api.list_namespaced_pod, self.namespace):
-					object = event['object']
-					etype = event['type']
-					uid = (object.metadata.namespace, object.metadata.name)
-					if uid in self.resources["pods"]:
-						if etype == "MODIFIED":
-
-							#print("************************************\n%s %s\n%s" \
-							#      % (etype, object.metadata.name, object))
-
-							ready = 0
-							total = len(object.spec.containers)
-							pod_name_ip = "n/a"
-							status = object.status.phase
-							if object.status.reason is not None:
-								status = object.status.reason
-							if object.spec.node_name and object.spec.node_name != "":
-								pod_name_ip = object.spec.node_name
-							if object.status.pod_ip and object.status.pod_ip != "":
-								pod_name_ip += "/" + object.status.pod_ip
-
-							initializing = False
-
-							# On Kubernetes 1.5, get init container status out of the annotation manually
-							if not object.status.init_container_statuses \
-							   and object.metadata.annotations \
-							   and "pod.alpha.kubernetes.io/init-container-statuses" in object.metadata.annotations:
-								jp = json.loads(object.metadata.annotations["pod.alpha.kubernetes.io/init-containers"])
-								js = json.loads(object.metadata.annotations["pod.alpha.kubernetes.io/init-container-statuses"])
-								a = ApiClient()
-								object.spec.init_containers = \
-									a._ApiClient__deserialize(jp, "list[V1Container]")
-								object.status.init_container_statuses = \
-									a._ApiClient__deserialize(js, "list[V1ContainerStatus]")
-
-							if object.status.init_container_statuses is not None:
-								for i, cs in enumerate(object.status.init_container_statuses):
-									if cs.state.terminated and cs.state.terminated.exit_code == 0:
-										continue
-									elif cs.state.terminated:
-										if len(cs.state.terminated.reason) == 0:
-											if cs.state.terminated.signal != 0:
-												status = "Init:Signal:%d" % cs.state.terminated.signal
-											else:
-												status = "Init:ExitCode:%d" % cs.state.terminated.exit_code
-										else:
-											status = "Init:" + cs.state.terminated.reason
-										initializing = True
-									elif cs.state.waiting and len(cs.state.waiting.reason) > 0 \
-										 and cs.state.waiting.reason != "PodInitializing":
-										status = "Init:" + cs.state.waiting.reason
-										initializing = True
-									else:
-										status = "Init:%d/%d" % (i, len(object.spec.init_containers))
-										initializing = True
-									break
-
-							if not initializing and object.status.container_statuses is not None:
-								for cs in object.status.container_statuses:
-									if cs.ready: ready += 1
-									if cs.state.waiting and cs.state.waiting.reason != "":
-										status = cs.state.waiting.reason
-									elif cs.state.terminated and cs.state.terminated.reason != "":
-										status = cs.state.terminated.reason
-									elif cs.state.terminated and cs.state.terminated.reason == "":
-										if cs.state.terminated.signal != 0:
-											status = "Signal:%d" % cs.state.terminated.signal
-										else:
-											statis = "ExitCode:%d" % cs.state.terminated.exit_code
-
-							print(" - %-24s %-18s %d/%d  %s" \
-								  % (object.metadata.name, status, ready, total, pod_name_ip))
-
-							self.resources["pods"][uid]["phase"] = object.status.phase
-							self.resources["pods"][uid]["status"] = status
-							self.resources["pods"][uid]["ready"] = ready
-							self.resources["pods"][uid]["total"] = total
-							if ((object.status.phase == "Succeeded" or object.status.phase == "Failed")
-								and object.metadata.deletion_timestamp == None):
-
-								if object.status.phase == "Failed":
-									return False
-
-								#print("Pod %s/%s is finished" % (object.metadata.namespace, object.metadata.name))
-								#self.delete_all()
-
-							if object.status.container_statuses is not None:
-								for c in filter(lambda c: c.state.terminated, object.status.container_statuses):
-
-									# If any container failed, assume overall failure
-									if c.state.terminated.exit_code != 0:
-										print("Container '%s' of pod '%s:%s' failed"
-											  % (c.name, uid[0], uid[1]))
-										return False
-
-									# If a sufficient container completed, assume overall completion
-									elif c.name in self.resources["pods"][uid]["sufficient_containers"]:
-										print("Container '%s' of pod '%s:%s' succeeded, finishing"
-											  % (c.name, uid[0], uid[1]))
-										return True
-
-						if etype == "DELETED":
-							print("Pod %s/%s has been deleted" % (object.metadata.namespace, object.metadata.name))
-							del self.resources["pods"][uid]
-							if not self.resources["pods"]:
-								w.stop()
-								print("Done watching events")
-
-					if not printed_all_up:
-						all_up = True
-						for k, p in self.resources["pods"].items():
-							if p["status"] != "Running":
-								all_up = False
-							if p["ready"] != p["total"]:
-								all_up = False
-						if all_up:
-							printed_all_up = True
-							all_up_time = datetime.now()
-							print("All pods up and running (setup took %s)" % str(all_up_time-start_time))
-
-			except Exception as e:
-				if str(e) != "TERM":
-					print("Exception while monitoring pods")
-					print(traceback.format_exc())
-				return False
+				if etype == "DELETED" and uid in resources[kind]:
+					if verbose: print("  - %s %s:%s" % (label, uid[0], uid[1]))
+					del resources[kind][uid]
+					if not resources[kind]: return
+
+	def _monitor_event(self, event, state):
+		# Processes one pod event while monitoring. Returns True if the job
+		# completed, False if it failed, and None to continue monitoring.
+		object = event['object']
+		etype = event['type']
+		uid = (object.metadata.namespace, object.metadata.name)
+		if uid in self.resources["pods"]:
+			if etype == "MODIFIED":
+
+				#print("************************************\n%s %s\n%s" \
+				#      % (etype, object.metadata.name, object))
+
+				ready = 0
+				total = len(object.spec.containers)
+				pod_name_ip = "n/a"
+				status = object.status.phase
+				if object.status.reason is not None:
+					status = object.status.reason
+				if object.spec.node_name and object.spec.node_name != "":
+					pod_name_ip = object.spec.node_name
+				if object.status.pod_ip and object.status.pod_ip != "":
+					pod_name_ip += "/" + object.status.pod_ip
+
+				initializing = False
+				terminal = None
+
+				# On Kubernetes 1.5, get init container status out of the annotation manually
+				if not object.status.init_container_statuses \
+				   and object.metadata.annotations \
+				   and "pod.alpha.kubernetes.io/init-container-statuses" in object.metadata.annotations:
+					jp = json.loads(object.metadata.annotations["pod.alpha.kubernetes.io/init-containers"])
+					js = json.loads(object.metadata.annotations["pod.alpha.kubernetes.io/init-container-statuses"])
+					a = ApiClient()
+					object.spec.init_containers = \
+						a._ApiClient__deserialize(jp, "list[V1Container]")
+					object.status.init_container_statuses = \
+						a._ApiClient__deserialize(js, "list[V1ContainerStatus]")
+
+				if object.status.init_container_statuses is not None:
+					for i, cs in enumerate(object.status.init_container_statuses):
+						if cs.state.terminated and cs.state.terminated.exit_code == 0:
+							continue
+						elif cs.state.terminated:
+							if len(cs.state.terminated.reason) == 0:
+								if cs.state.terminated.signal != 0:
+									status = "Init:Signal:%d" % cs.state.terminated.signal
+								else:
+									status = "Init:ExitCode:%d" % cs.state.terminated.exit_code
+							else:
+								status = "Init:" + cs.state.terminated.reason
+							initializing = True
+						elif cs.state.waiting and len(cs.state.waiting.reason) > 0 \
+							 and cs.state.waiting.reason != "PodInitializing":
+							status = "Init:" + cs.state.waiting.reason
+							initializing = True
+							if cs.state.waiting.reason in TERMINAL_WAITING_REASONS:
+								terminal = (cs.name, cs.state.waiting)
+						else:
+							status = "Init:%d/%d" % (i, len(object.spec.init_containers))
+							initializing = True
+						break
+
+				if not initializing and object.status.container_statuses is not None:
+					for cs in object.status.container_statuses:
+						if cs.ready: ready += 1
+						if cs.state.waiting and cs.state.waiting.reason != "":
+							status = cs.state.waiting.reason
+							if cs.state.waiting.reason in TERMINAL_WAITING_REASONS:
+								terminal = (cs.name, cs.state.waiting)
+						elif cs.state.terminated and cs.state.terminated.reason != "":
+							status = cs.state.terminated.reason
+						elif cs.state.terminated and cs.state.terminated.reason == "":
+							if cs.state.terminated.signal != 0:
+								status = "Signal:%d" % cs.state.terminated.signal
+							else:
+								status = "ExitCode:%d" % cs.state.terminated.exit_code
+
+				print(" - %-24s %-18s %d/%d  %s" \
+					  % (object.metadata.name, status, ready, total, pod_name_ip))
+
+				self.resources["pods"][uid]["phase"] = object.status.phase
+				self.resources["pods"][uid]["status"] = status
+				self.resources["pods"][uid]["ready"] = ready
+				self.resources["pods"][uid]["total"] = total
+				if terminal is not None:
+					(container, waiting) = terminal
+					return self._monitor_failed("Container '%s' of pod '%s:%s' is stuck in %s%s" \
+					                            % (container, uid[0], uid[1], waiting.reason,
+					                               ": " + waiting.message if waiting.message else ""))
+
+				if ((object.status.phase == "Succeeded" or object.status.phase == "Failed")
+					and object.metadata.deletion_timestamp == None):
+
+					if object.status.phase == "Failed":
+						return self._monitor_failed("Pod '%s:%s' failed%s" \
+						                            % (uid[0], uid[1], " (%s)" % object.status.reason
+						                                               if object.status.reason else ""))
+
+					#print("Pod %s/%s is finished" % (object.metadata.namespace, object.metadata.name))
+					#self.delete_all()
+
+				if object.status.container_statuses is not None:
+					for c in filter(lambda c: c.state.terminated, object.status.container_statuses):
+
+						# If any container failed, assume overall failure
+						if c.state.terminated.exit_code != 0:
+							return self._monitor_failed("Container '%s' of pod '%s:%s' failed with exit code %d"
+							                            % (c.name, uid[0], uid[1], c.state.terminated.exit_code))
+
+						# If a sufficient container completed, assume overall completion
+						elif c.name in self.resources["pods"][uid]["sufficient_containers"]:
+							print("Container '%s' of pod '%s:%s' succeeded, finishing"
+								  % (c.name, uid[0], uid[1]))
+							return True
+
+			if etype == "DELETED":
+				print("Pod %s/%s has been deleted" % (object.metadata.namespace, object.metadata.name))
+				del self.resources["pods"][uid]
+				if not self.resources["pods"]:
+					print("Done watching events")
+					return True
+
+		if not state["printed_all_up"]:
+			all_up = True
+			for k, p in self.resources["pods"].items():
+				if p["status"] != "Running":
+					all_up = False
+				if p["ready"] != p["total"]:
+					all_up = False
+			if all_up:
+				state["printed_all_up"] = True
+				all_up_time = datetime.now()
+				state["all_up_time"] = all_up_time
+				print("All pods up and running (setup took %s)" % str(all_up_time-state["start_time"]))
+				if self.timer is not None:
+					self.timer.observe("schedule_to_all_up", (all_up_time-state["start_time"]).total_seconds())
+
+		return None
+
+	def _monitor_failed(self, reason):
+		print(reason)
+		self.failure_reason = reason
+		return False
+
+	def _check_deadlines(self, state):
+		# Watchdog, returns False if the setup or the game took too long,
+		# None otherwise. Deadlines are in seconds, None disables them.
+		now = datetime.now()
+		if state["all_up_time"] is None:
+			if state["setup_deadline"] is not None and \
+			   (now - state["start_time"]).total_seconds() > state["setup_deadline"]:
+				not_up = ["%s:%s (%s)" % (uid[0], uid[1], p["status"])
+				          for (uid, p) in self.resources["pods"].items()
+				          if p["status"] != "Running" or p["ready"] != p["total"]]
+				return self._monitor_failed("Setup deadline of %d s exceeded, pods not up: %s" \
+				                            % (state["setup_deadline"], ", ".join(not_up)))
+		elif state["game_deadline"] is not None and \
+		     (now - state["all_up_time"]).total_seconds() > state["game_deadline"]:
+			return self._monitor_failed("Game deadline of %d s exceeded" % state["game_deadline"])
+		return None
+
+	def monitor_pods(self, heartbeat=None, heartbeat_interval=30, setup_deadline=None, game_deadline=None):
+		# If given, heartbeat is called about every heartbeat_interval seconds
+		# while monitoring. If it returns False, monitoring is aborted and the
+		# job is considered failed. The job also fails if not all pods are
+		# up within setup_deadline seconds or the game did not finish within
+		# game_deadline seconds after that. The reason of a failure is
+		# available as failure_reason.
+		state = { "start_time": datetime.now(), "printed_all_up": False, "all_up_time": None,
+		          "setup_deadline": setup_deadline, "game_deadline": game_deadline }
+		self.failure_reason = None
+		last_heartbeat = 0
+		if not self.resources["pods"]: return True
+		try:
+			with self.informer("pods").subscribe() as sub:
+				# Pods already in the cache are handled like modifications,
+				# the subscription then delivers all changes from that state on
+				events = itertools.chain([{"type": "MODIFIED", "object": o} for o in sub.snapshot],
+				                         sub.events(idle=True))
+				for event in events:
+					if heartbeat is not None and time.time() - last_heartbeat >= heartbeat_interval:
+						last_heartbeat = time.time()
+						if not heartbeat():
+							return self._monitor_failed("Heartbeat failed, aborting monitoring")
+					if event['type'] != "IDLE":
+						result = self._monitor_event(event, state)
+						if result is not None:
+							return result
+					result = self._check_deadlines(state)
+					if result is not None:
+						return result
+
+		except Exception as e:
+			if str(e) != "TERM":
+				print("Exception while monitoring pods")
+				print(traceback.format_exc())
+			self.failure_reason = "Exception while monitoring pods: %s" % str(e)
+			return False
 
 		return True
+
+	async def monitor_pods_async(self, heartbeat=None, heartbeat_interval=30,
+	                             setup_deadline=None, game_deadline=None):
+		# Same as monitor_pods, but waits for events within the event loop
+		# instead of blocking a thread. The blocking heartbeat is run in the
+		# loop's executor.
+		loop = asyncio.get_event_loop()
+		state = { "start_time": datetime.now(), "printed_all_up": False, "all_up_time": None,
+		          "setup_deadline": setup_deadline, "game_deadline": game_deadline }
+		self.failure_reason = None
+		last_heartbeat = 0
+		if not self.resources["pods"]: return True
+		try:
+			with self.informer("pods").subscribe(loop=loop) as sub:
+				pending = [{"type": "MODIFIED", "object": o} for o in sub.snapshot]
+				while True:
+					if heartbeat is not None and time.time() - last_heartbeat >= heartbeat_interval:
+						last_heartbeat = time.time()
+						if not await loop.run_in_executor(None, heartbeat):
+							return self._monitor_failed("Heartbeat failed, aborting monitoring")
+					event = None
+					if pending:
+						event = pending.pop(0)
+					else:
+						try:
+							event = await asyncio.wait_for(sub.get(),
+							                               min(heartbeat_interval, WATCHDOG_INTERVAL))
+						except asyncio.TimeoutError:
+							pass
+					if event is not None:
+						result = self._monitor_event(event, state)
+						if result is not None:
+							return result
+					result = self._check_deadlines(state)
+					if result is not None:
+						return result
+
+		except asyncio.CancelledError:
+			raise
+		except Exception as e:
+			print("Exception while monitoring pods")
+			print(traceback.format_exc())
+			self.failure_reason = "Exception while monitoring pods: %s" % str(e)
+			return False
@@ -1,20 +1,100 @@
 #!/usr/bin/env python3
 
 import pymongo
-from pymongo import ReturnDocument
-from pymongo.errors import ConnectionFailure
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import ConnectionFailure, BulkWriteError
 
+import collections
 import datetime
 import dns.resolver
+import hashlib
+import json
+import re
+import threading
+import zlib
+
+# Version of the job document layout, documents of older versions are
+# migrated when connecting to the queue
+SCHEMA_VERSION = 6
+
+# Job states, the stats collection keeps a counter per tournament for each
+# of them and for pending jobs which failed before
+STATES = ["pending", "running", "completed", "cancelled"]
+STATS_KEYS = STATES + ["failed"]
+
+# Fields required to account a transition of a job
+TRANSITION_PROJECTION = {"name": 1, "tournament": 1, "status.state": 1,
+                         "status.failed": {"$slice": -1}}
+CLAIM_PROJECTION = dict(TRANSITION_PROJECTION, params=1, params_hash=1)
+
+# Read views of jobs. The summary and status views only fetch the fields
+# they contain and are returned as named tuples, the full view returns the
+# whole job document. Parameter documents and manifests are only
+# referenced by hash, use job_params and job_manifests to fetch them.
+JobSummary = collections.namedtuple("JobSummary",
+                                    ["name", "idnum", "tournament", "state",
+                                     "team_cyan", "team_magenta"])
+JobStatus = collections.namedtuple("JobStatus", JobSummary._fields + \
+                                   ("num_failed", "last_failed", "failure_reason", "created",
+                                    "running", "completed", "cancelled", "owner",
+                                    "lease_expires", "next_eligible_at", "params_hash",
+                                    "timings"))
+VIEW_PROJECTIONS = {
+	"summary": {"_id": 0, "name": 1, "idnum": 1, "tournament": 1, "status.state": 1,
+	            "params.parameter_vars.team_name_cyan": 1,
+	            "params.parameter_vars.team_name_magenta": 1},
+	"status": {"_id": 0, "name": 1, "idnum": 1, "tournament": 1, "status": 1,
+	           "params.parameter_vars.team_name_cyan": 1,
+	           "params.parameter_vars.team_name_magenta": 1,
+	           "next_eligible_at": 1, "params_hash": 1},
+	"full": None
+}
+
+# Jobs which failed are not claimed again before this time has passed
+# (unless explicitly asked for)
+RETRY_DELAY = datetime.timedelta(minutes=15)
+
+# Claimed jobs are leased to the claiming controller, which must renew the
+# lease before it expires. Jobs with expired leases are returned to the
+# queue, checked at most every REAP_INTERVAL when claiming.
+LEASE_DURATION = datetime.timedelta(minutes=10)
+REAP_INTERVAL = datetime.timedelta(minutes=1)
+
+# Large job data, i.e., the parameter document and the rendered manifests,
+# is kept zlib-compressed in a blob collection keyed by the SHA-1 of the
+# content. Jobs reference blobs by hash, identical content is stored once.
+# Blobs no longer referenced by any job, e.g., manifests of requeued jobs,
+# are removed by sweep_blobs (cf. sweep-blobs) once they have not been
+# stored again for BLOB_SWEEP_GRACE.
+# BLOB_PARAMS are the fields of the job parameters moved to a blob.
+BLOB_PARAMS = ["parameter_doc_yaml", "template_parameters"]
+BLOB_CACHE_SIZE = 256
+BLOB_SWEEP_GRACE = datetime.timedelta(hours=1)
+# Blob hashes as referenced by jobs
+BLOB_HASH_RE = re.compile("^[0-9a-f]{40}$")
+
+# Jobs of a tournament in order of creation
+ID_SORT = [("idnum", pymongo.ASCENDING)]
+
+# Oldest eligible job first, matches the order of the claim indexes
+CLAIM_SORT = [("next_eligible_at", pymongo.ASCENDING), ("status.created", pymongo.ASCENDING)]
 
 class WorkQueue(object):
 	def	__init__(self, database=None, collection=None,
 				 host=None, port=None, srv_name=None, uri=None,
-				 replicaset=None, count_collection="counters"):
+				 replicaset=None, count_collection="counters", slot_collection="namespace_slots",
+				 stats_collection="stats", blob_collection="blobs",
+				 retry_delay=RETRY_DELAY, lease_duration=LEASE_DURATION):
 
 		self.database_name = database or "workqueue"
 		self.collection_name = collection or "q"
 		self.count_collection_name = count_collection
+		self.retry_delay = retry_delay
+		self.lease_duration = lease_duration
+		self.last_reap = None
+		# Slot and prefetch threads read blobs concurrently
+		self.blob_cache = collections.OrderedDict()
+		self.blob_cache_lock = threading.Lock()
 
 		if host is not None and port is not None:
 			self.client = pymongo.MongoClient(host, port, replicaset=replicaset)
@@ -42,147 +122,820 @@ class WorkQueue(object):
 		self.db = self.client[self.database_name]
 		self.collection = self.db[self.collection_name]
 		self.collection.create_index([('name', pymongo.ASCENDING)], unique=True)
+		# Claims are equality matches on state (and tournament) with a range
+		# on next_eligible_at, sorted by next_eligible_at and creation time.
+		# These indexes answer them without scanning or sorting in memory.
+		self.collection.create_index([('status.state', pymongo.ASCENDING),
+		                              ('tournament', pymongo.ASCENDING),
+		                              ('next_eligible_at', pymongo.ASCENDING),
+		                              ('status.created', pymongo.ASCENDING)])
+		self.collection.create_index([('status.state', pymongo.ASCENDING),
+		                              ('next_eligible_at', pymongo.ASCENDING),
+		                              ('status.created', pymongo.ASCENDING)])
+		self.collection.create_index([('status.state', pymongo.ASCENDING),
+		                              ('status.lease_expires', pymongo.ASCENDING)])
+		# Job listings of a tournament, ordered by ID
+		self.collection.create_index([('tournament', pymongo.ASCENDING),
+		                              ('idnum', pymongo.ASCENDING)])
 
 		self.count_collection = self.db[self.count_collection_name]
+		self.slot_collection = self.db[slot_collection]
+		self.stats_collection = self.db[stats_collection]
+		self.blob_collection = self.db[blob_collection]
+		self.slot_collection.create_index([('prefix', pymongo.ASCENDING),
+		                                   ('index', pymongo.ASCENDING)])
+		self.migrate()
+
+	@staticmethod
+	def tournament_of(name):
+		# Job names are of the form <tournament>:<id>:<pairing>
+		return name.split(":", 1)[0]
+
+	@staticmethod
+	def params_hash(params):
+		# Content hash of the rendered parameter document, None if the job
+		# has none
+		if "parameter_doc_yaml" not in params:
+			return None
+		return hashlib.sha1(params["parameter_doc_yaml"].encode('utf-8')).hexdigest()
+
+	def migrate(self):
+		schema = self.count_collection.find_one({"_id": "workqueue_schema"})
+		version = schema["version"] if schema is not None else 1
+		if version >= SCHEMA_VERSION:
+			return
+		if version < 2:
+			self._migrate_eligibility()
+		if version < 3:
+			print("Building work queue stats")
+			self.reconcile_stats()
+		if version < 4:
+			self._migrate_params_hash()
+		if version < 5:
+			self._migrate_blobs()
+		if version < 6:
+			self._migrate_manifest_blobs()
+		self.count_collection.update_one({"_id": "workqueue_schema"},
+		                                 {"$set": {"version": SCHEMA_VERSION}}, upsert=True)
+
+	def _migrate_eligibility(self, batch_size=1000):
+		# Add tournament and next_eligible_at to documents created by older
+		# versions. The eligibility time is derived from the last failure.
+		num_migrated = 0
+		requests = []
+		projection = {"name": 1, "status.created": 1, "status.failed": 1}
+		for doc in self.collection.find({"next_eligible_at": {"$exists": False}}, projection):
+			status = doc.get("status", {})
+			next_eligible_at = status.get("created", datetime.datetime.utcnow())
+			if status.get("failed"):
+				next_eligible_at = max(next_eligible_at, max(status["failed"]) + self.retry_delay)
+			requests.append(UpdateOne({"_id": doc["_id"]},
+			                          {"$set": {"tournament": WorkQueue.tournament_of(doc["name"]),
+			                                    "next_eligible_at": next_eligible_at}}))
+			if len(requests) >= batch_size:
+				num_migrated += self.collection.bulk_write(requests, ordered=False).modified_count
+				requests = []
+		if requests:
+			num_migrated += self.collection.bulk_write(requests, ordered=False).modified_count
+		if num_migrated > 0:
+			print("Migrated %d jobs to explicit tournament and eligibility" % num_migrated)
+		return num_migrated
+
+	def _migrate_params_hash(self, batch_size=1000):
+		# Add the hash of the parameter document to documents created by
+		# older versions
+		num_migrated = 0
+		requests = []
+		projection = {"name": 1, "params.parameter_doc_yaml": 1}
+		for doc in self.collection.find({"params_hash": {"$exists": False}}, projection):
+			requests.append(UpdateOne({"_id": doc["_id"]},
+			                          {"$set": {"params_hash": WorkQueue.params_hash(doc.get("params", {}))}}))
+			if len(requests) >= batch_size:
+				num_migrated += self.collection.bulk_write(requests, ordered=False).modified_count
+				requests = []
+		if requests:
+			num_migrated += self.collection.bulk_write(requests, ordered=False).modified_count
+		if num_migrated > 0:
+			print("Migrated %d jobs to parameter document hashes" % num_migrated)
+		return num_migrated
+
+	def _migrate_blobs(self, batch_size=100):
+		# Move parameter documents and manifests embedded by older versions
+		# into the blob store
+		num_migrated = 0
+		filter = {"$or": [{"params.parameter_doc_yaml": {"$exists": True}},
+		                  {"manifests.0": {"$exists": True, "$not": BLOB_HASH_RE}}]}
+		projection = {"params": 1, "manifests": 1}
+		blobs = {}
+		requests = []
+		for doc in self.collection.find(filter, projection):
+			update = {}
+			if "params" in doc and "parameter_doc_yaml" in doc["params"]:
+				(params, blob_hash, data) = WorkQueue._params_blob(doc["params"])
+				blobs[blob_hash] = data
+				update["params"] = params
+			if doc.get("manifests") and not BLOB_HASH_RE.match(doc["manifests"][0]):
+				update["manifest_blobs"] = []
+				for manifest in doc["manifests"]:
+					data = manifest.encode('utf-8')
+					blob_hash = WorkQueue.blob_hash(data)
+					blobs[blob_hash] = data
+					update["manifest_blobs"].append(blob_hash)
+				# Removed, so that the filter does not match migrated jobs if
+				# the migration runs again, e.g., after it was interrupted or
+				# by several controllers at once
+				requests.append(UpdateOne({"_id": doc["_id"]},
+				                          {"$set": update, "$unset": {"manifests": ""}}))
+			else:
+				requests.append(UpdateOne({"_id": doc["_id"]}, {"$set": update}))
+			if len(requests) >= batch_size:
+				self.put_blobs(blobs)
+				num_migrated += self.collection.bulk_write(requests, ordered=False).modified_count
+				blobs = {}
+				requests = []
+		if requests:
+			self.put_blobs(blobs)
+			num_migrated += self.collection.bulk_write(requests, ordered=False).modified_count
+		if num_migrated > 0:
+			print("Migrated %d jobs to blob storage" % num_migrated)
+		return num_migrated
+
+	def _migrate_manifest_blobs(self):
+		# Schema version 5 stored the manifest blob hashes in manifests,
+		# move them to manifest_blobs. Only lists of hashes are moved,
+		# embedded manifests are dicts rendered as str.
+		n = self.collection.update_many({"manifests.0": BLOB_HASH_RE},
+		                                {"$rename": {"manifests": "manifest_blobs"}}).modified_count
+		if n > 0:
+			print("Migrated %d jobs to manifest blob references" % n)
+		return n
 
 	def clear(self):
 		self.collection.delete_many({})
 		self.count_collection.delete_many({})
+		self.stats_collection.delete_many({})
+		self.blob_collection.delete_many({})
+		with self.blob_cache_lock:
+			self.blob_cache.clear()
+
+	@staticmethod
+	def blob_hash(data):
+		return hashlib.sha1(data).hexdigest()
+
+	def put_blobs(self, blobs):
+		# Stores a dict mapping hashes to data. The data of blobs which
+		# already exist is left untouched, but they are marked as stored
+		# again, which keeps them from being swept before the job
+		# referencing them has been written.
+		now = datetime.datetime.utcnow()
+		requests = []
+		for (blob_hash, data) in blobs.items():
+			requests.append(UpdateOne({"_id": blob_hash},
+			                          {"$setOnInsert": {"data": zlib.compress(data),
+			                                            "size": len(data),
+			                                            "created": now},
+			                           "$set": {"stored": now}},
+			                          upsert=True))
+		if requests:
+			self.blob_collection.bulk_write(requests, ordered=False)
+
+	def put_blob(self, data):
+		blob_hash = WorkQueue.blob_hash(data)
+		self.put_blobs({blob_hash: data})
+		return blob_hash
+
+	def sweep_blobs(self, grace=BLOB_SWEEP_GRACE, dry_run=False, batch_size=1000):
+		# Deletes blobs which are not referenced by any job and have not
+		# been stored for the grace period. Blobs stored again while
+		# sweeping are kept. Returns the number of unreferenced blobs and
+		# their uncompressed size.
+		cutoff = datetime.datetime.utcnow() - grace
+		candidates = {}
+		for doc in self.blob_collection.find({"stored": {"$not": {"$gte": cutoff}}},
+		                                     {"size": 1}, batch_size=batch_size):
+			candidates[doc["_id"]] = doc.get("size", 0)
+		if candidates:
+			for doc in self.collection.find({}, {"_id": 0, "params.blob": 1, "manifest_blobs": 1},
+			                                batch_size=batch_size):
+				candidates.pop(doc.get("params", {}).get("blob"), None)
+				for blob_hash in doc.get("manifest_blobs", []):
+					candidates.pop(blob_hash, None)
+		if not dry_run:
+			unreferenced = list(candidates.keys())
+			for batch_start in range(0, len(unreferenced), batch_size):
+				self.blob_collection.delete_many({"_id": {"$in": unreferenced[batch_start:batch_start+batch_size]},
+				                                  "stored": {"$not": {"$gte": cutoff}}})
+			with self.blob_cache_lock:
+				for blob_hash in unreferenced:
+					self.blob_cache.pop(blob_hash, None)
+		return (len(candidates), sum(candidates.values()))
+
+	def get_blob(self, blob_hash):
+		# Blobs never change, hence recently used ones are cached
+		with self.blob_cache_lock:
+			if blob_hash in self.blob_cache:
+				self.blob_cache.move_to_end(blob_hash)
+				return self.blob_cache[blob_hash]
+		# Fetch outside of the lock, concurrent misses store the same data
+		doc = self.blob_collection.find_one({"_id": blob_hash})
+		if doc is None:
+			raise Exception("Blob %s does not exist" % blob_hash)
+		data = zlib.decompress(doc["data"])
+		with self.blob_cache_lock:
+			self.blob_cache[blob_hash] = data
+			if len(self.blob_cache) > BLOB_CACHE_SIZE:
+				self.blob_cache.popitem(last=False)
+		return data
+
+	@staticmethod
+	def _params_blob(params):
+		# Splits job parameters into the parameters stored with the job,
+		# which reference the blob, the blob hash, and the blob data
+		if "parameter_doc_yaml" not in params:
+			return (params, None, None)
+		data = json.dumps({key: params[key] for key in BLOB_PARAMS if key in params},
+		                  sort_keys=True).encode('utf-8')
+		blob_hash = WorkQueue.blob_hash(data)
+		stored = {key: value for (key, value) in params.items() if key not in BLOB_PARAMS}
+		stored["blob"] = blob_hash
+		return (stored, blob_hash, data)
+
+	def store_params(self, params):
+		# Returns the parameters to store with a job, the parameter document
+		# is put into the blob store
+		(stored, blob_hash, data) = WorkQueue._params_blob(params)
+		if blob_hash is not None:
+			self.put_blobs({blob_hash: data})
+		return stored
+
+	def job_params(self, job):
+		# Full parameters of a job document, fetching the parameter document
+		# from the blob store. Returns a new dict on each call.
+		params = dict(job["params"])
+		if "blob" in params:
+			params.update(json.loads(self.get_blob(params.pop("blob")).decode('utf-8')))
+		return params
+
+	def distinct_params(self, tournament=None, state=None):
+		# One job document (name and params only) per distinct parameter
+		# document among the matching jobs, pass them to job_params
+		filter = {}
+		if tournament is not None:
+			filter["tournament"] = tournament
+		if state is not None:
+			filter["status.state"] = state
+		cursor = self.collection.aggregate(\
+		    [{"$match": filter},
+		     {"$group": {"_id": "$params_hash", "name": {"$first": "$name"},
+		                 "params": {"$first": "$params"}}}],
+		    allowDiskUse=True)
+		for doc in cursor:
+			yield {"name": doc["name"], "params": doc["params"]}
+
+	def set_manifests(self, name, manifests):
+		# Stores the rendered manifests (list of str) of a job
+		blobs = {WorkQueue.blob_hash(m.encode('utf-8')): m.encode('utf-8') for m in manifests}
+		self.put_blobs(blobs)
+		hashes = [WorkQueue.blob_hash(m.encode('utf-8')) for m in manifests]
+		self.collection.update_one({"name": name}, {"$set": {"manifest_blobs": hashes}})
+
+	def set_timings(self, name, timings):
+		# Stores the durations in seconds of the phases of the last run of a
+		# job, a dict from phase name to duration
+		self.collection.update_one({"name": name}, {"$set": {"status.timings": timings}})
+
+	def job_manifests(self, job):
+		return [self.get_blob(blob_hash).decode('utf-8') for blob_hash in job.get("manifest_blobs", [])]
+
+	@staticmethod
+	def _stats_contribution(state, has_failed):
+		contribution = {state: 1}
+		if state == "pending" and has_failed:
+			contribution["failed"] = 1
+		return contribution
+
+	def _count_transition(self, tournament, before, after, n=1):
+		# Moves n jobs between the stats counters of a tournament. before
+		# and after are (state, has failed) tuples, None for no job.
+		inc = {}
+		if after is not None:
+			for (key, value) in WorkQueue._stats_contribution(*after).items():
+				inc[key] = inc.get(key, 0) + n * value
+		if before is not None:
+			for (key, value) in WorkQueue._stats_contribution(*before).items():
+				inc[key] = inc.get(key, 0) - n * value
+		inc = {key: value for (key, value) in inc.items() if value != 0}
+		if inc:
+			self.stats_collection.update_one({"_id": tournament}, {"$inc": inc}, upsert=True)
+
+	def _transition(self, filter, update, projection=TRANSITION_PROJECTION, sort=None):
+		# Updates a single job and moves it between the stats counters if
+		# the update changes its state or adds a failure. Counter updates are
+		# not transactional with the job update, reconcile_stats repairs drift.
+		# Returns the job document before the update or None if none matched.
+		doc = self.collection.find_one_and_update(filter, update, projection, sort=sort)
+		if doc is None:
+			return None
+		new_state = update.get("$set", {}).get("status.state")
+		failing = "status.failed" in update.get("$push", {})
+		if new_state is not None or failing:
+			old_state = doc["status"]["state"]
+			has_failed = bool(doc["status"].get("failed"))
+			self._count_transition(doc.get("tournament"), (old_state, has_failed),
+			                       (new_state or old_state, has_failed or failing))
+		return doc
 
 	def get_next_id(self):
+		return self.get_next_ids(1)
+
+	def get_next_ids(self, n):
+		# Reserve a block of n consecutive IDs with a single round trip,
+		# returns the first ID of the block
+		if n <= 0:
+			raise ValueError("Must reserve at least one ID")
 		filter = {"_id": "workqueue_counter"}
-		update = {"$inc": { "count": 1 }}
+		update = {"$inc": { "count": n }}
 		doc = self.count_collection.find_one_and_update(filter, update,
 		                                                upsert=True,
 		                                                return_document=ReturnDocument.AFTER)
-		return doc["count"]
+		return doc["count"] - n + 1
 
-	def add_item(self, name, idnum, params):
-		doc = \
+	def _item_doc(self, name, idnum, params, stored_params):
+		now = datetime.datetime.utcnow()
+		return \
 		{
 			"name": name,
 			"idnum": idnum,
-			"params": params,
+			"tournament": WorkQueue.tournament_of(name),
+			"params": stored_params,
+			"params_hash": WorkQueue.params_hash(params),
+			"next_eligible_at": now,
 			"status": {
 				"state": "pending",
-				"created": datetime.datetime.utcnow(),
+				"created": now,
 			}
 		}
-		self.collection.insert_one(doc)
 
-	def get_specific_item(self, name):
-		filter = {"name": name}
-		item = self.collection.find_one(filter)
+	def add_item(self, name, idnum, params):
+		self.collection.insert_one(self._item_doc(name, idnum, params, self.store_params(params)))
+		self._count_transition(WorkQueue.tournament_of(name), None, ("pending", False))
+
+	def add_items(self, items, batch_size=1000):
+		# Insert (name, idnum, params) tuples using ordered insert_many batches.
+		# An ordered insert stops at the first failing document, therefore the
+		# remainder of a batch is re-submitted after recording the failure.
+		# Returns a dict mapping names of items which could not be stored
+		# to the respective error message.
+		failed = {}
+		docs = []
+		blobs = {}
+		for (name, idnum, params) in items:
+			(stored, blob_hash, data) = WorkQueue._params_blob(params)
+			if blob_hash is not None:
+				blobs[blob_hash] = data
+			docs.append(self._item_doc(name, idnum, params, stored))
+		self.put_blobs(blobs)
+		# Counted from the inserted documents, failed is keyed by name and
+		# a name may occur more than once
+		added = {}
+		def count_added(inserted):
+			for doc in inserted:
+				added[doc["tournament"]] = added.get(doc["tournament"], 0) + 1
+		for batch_start in range(0, len(docs), batch_size):
+			batch = docs[batch_start:batch_start+batch_size]
+			while batch:
+				try:
+					self.collection.insert_many(batch, ordered=True)
+					count_added(batch)
+					batch = []
+				except BulkWriteError as e:
+					write_errors = e.details.get("writeErrors", [])
+					if not write_errors:
+						raise
+					error = write_errors[0]
+					count_added(batch[:error["index"]])
+					failed[batch[error["index"]]["name"]] = error["errmsg"]
+					batch = batch[error["index"]+1:]
+
+		for (tournament, n) in added.items():
+			self._count_transition(tournament, None, ("pending", False), n)
+		return failed
+
+	@staticmethod
+	def _view(view, doc):
+		if view == "full":
+			return doc
+		status = doc.get("status", {})
+		param_vars = doc.get("params", {}).get("parameter_vars", {})
+		summary = (doc["name"], doc.get("idnum"), doc.get("tournament"), status.get("state"),
+		           param_vars.get("team_name_cyan"), param_vars.get("team_name_magenta"))
+		if view == "summary":
+			return JobSummary(*summary)
+		failed = status.get("failed", [])
+		return JobStatus(*summary,
+		                 num_failed=len(failed),
+		                 last_failed=failed[-1] if failed else None,
+		                 failure_reason=status.get("failure_reason"),
+		                 created=status.get("created"),
+		                 running=status.get("running"),
+		                 completed=status.get("completed"),
+		                 cancelled=status.get("cancelled"),
+		                 owner=status.get("owner"),
+		                 lease_expires=status.get("lease_expires"),
+		                 next_eligible_at=doc.get("next_eligible_at"),
+		                 params_hash=doc.get("params_hash"),
+		                 timings=status.get("timings"))
+
+	def get_specific_item(self, name, view="full"):
+		item = self.collection.find_one({"name": name}, VIEW_PROJECTIONS[view])
 		#print("Item: %s" % item)
-		return item
+		return WorkQueue._view(view, item) if item is not None else None
 
-	def get_items(self, name_regex):
-		filter = {"name": { "$regex": name_regex }}
-		for i in self.collection.find(filter).sort('_id', pymongo.ASCENDING):
-			yield i
-	
-	def get_next_item(self, recently_failed_deadline=None, name_regex=None):
-		filter = {"status.state": "pending"}
+	def find_items(self, view="summary", tournament=None, name_regex=None, state=None,
+	               sort=None, batch_size=1000):
+		# Streams jobs in the given view ("summary", "status", or "full"),
+		# fetched from the server in batches. sort is a list of (field,
+		# direction) tuples, e.g., [("idnum", pymongo.ASCENDING)].
+		filter = {}
+		if tournament is not None:
+			filter["tournament"] = tournament
 		if name_regex is not None:
 			filter["name"] = { "$regex": name_regex }
-		if recently_failed_deadline is not None:
-			filter["$or"] = [ {"status.failed": { "$exists": False} },
-			                  {"status.failed": { "$size": 0} },
-			                  {"status.failed": { "$elemMatch": { "$lte": recently_failed_deadline}}}]
+		if state is not None:
+			filter["status.state"] = state
+		cursor = self.collection.find(filter, VIEW_PROJECTIONS[view], batch_size=batch_size)
+		if sort is not None:
+			cursor = cursor.sort(sort)
+		for doc in cursor:
+			yield WorkQueue._view(view, doc)
+
+	def get_items(self, name_regex, state=None):
+		yield from self.find_items("full", name_regex=name_regex, state=state,
+		                           sort=[('_id', pymongo.ASCENDING)])
+	
+	def ensure_reuse_index(self):
+		# Controllers reusing their environment prefer jobs with the same
+		# parameter document, the hash implies the tournament. The index is
+		# only created if such a controller runs, other deployments do not
+		# pay for maintaining it.
+		self.collection.create_index([('status.state', pymongo.ASCENDING),
+		                              ('params_hash', pymongo.ASCENDING),
+		                              ('next_eligible_at', pymongo.ASCENDING),
+		                              ('status.created', pymongo.ASCENDING)])
+
+	def _claim_filter(self, include_recently_failed=False, tournament=None, params_hash=None):
+		filter = {"status.state": "pending"}
+		if tournament is not None:
+			filter["tournament"] = tournament
+		if params_hash is not None:
+			filter["params_hash"] = params_hash
+		if not include_recently_failed:
+			filter["next_eligible_at"] = {"$lte": datetime.datetime.utcnow()}
+		return filter
+
+	def get_next_item(self, include_recently_failed=False, tournament=None, owner=None,
+	                  prefer_params_hash=None):
+		# If prefer_params_hash is given, a job with that parameter hash is
+		# claimed if there is one, otherwise the oldest eligible job
+		now = datetime.datetime.utcnow()
+		if self.last_reap is None or now - self.last_reap >= REAP_INTERVAL:
+			self.last_reap = now
+			for (name, lease_owner) in self.reap_expired_leases():
+				print("Returned job %s to queue, lease of %s expired" % (name, lease_owner))
+
 		update = {"$set": {"status.state": "running",
-		                   "status.running": datetime.datetime.utcnow()}}
-		sort = [("status.created", pymongo.ASCENDING)]
-		item = self.collection.find_one_and_update(filter, update, sort=sort)
+		                   "status.running": now}}
+		if owner is not None:
+			update["$set"]["status.owner"] = owner
+			update["$set"]["status.lease_expires"] = now + self.lease_duration
+		item = None
+		if prefer_params_hash is not None:
+			filter = self._claim_filter(include_recently_failed, tournament, prefer_params_hash)
+			item = self._transition(filter, update, projection=CLAIM_PROJECTION, sort=CLAIM_SORT)
+		if item is None:
+			filter = self._claim_filter(include_recently_failed, tournament)
+			item = self._transition(filter, update, projection=CLAIM_PROJECTION, sort=CLAIM_SORT)
 		#print("Item: %s" % item)
 		if item is None:
 			return None
 		else:
-			return { "name": item["name"], "params": item["params"] }
+			return { "name": item["name"], "params": item["params"],
+			         "params_hash": item.get("params_hash") }
 
+	def explain_claim(self, include_recently_failed=False, tournament=None, params_hash=None):
+		# Returns the query plan explanation of the claim query
+		filter = self._claim_filter(include_recently_failed, tournament, params_hash)
+		return self.collection.find(filter).sort(CLAIM_SORT).limit(1).explain()
 
-	def mark_item_done(self, name):
+	def _owned_filter(self, name, owner):
+		# If an owner is given, only match the job if it still holds the
+		# lease, it may have been reaped and claimed by someone else
 		filter = {"name": name}
+		if owner is not None:
+			filter["status.state"] = "running"
+			filter["status.owner"] = owner
+		return filter
+
+	def mark_item_done(self, name, owner=None):
 		update = {"$set": {"status.state": "completed",
-		                   "status.completed": datetime.datetime.utcnow()}}
-		self.collection.update_one(filter, update)
+		                   "status.completed": datetime.datetime.utcnow()},
+		          "$unset": {"status.owner": "", "status.lease_expires": ""}}
+		return self._transition(self._owned_filter(name, owner), update) is not None
 
-	def requeue_item(self, name, mark_failed=True):
-		filter = {"name": name}
+	def requeue_item(self, name, mark_failed=True, owner=None, reason=None):
+		# If the job is marked failed, reason describes the failure
 		update = {"$set":   {"status.state": "pending"},
-		          "$unset": {"manifests": "", "status.running": "", "status.completed": ""}}
+		          "$unset": {"manifest_blobs": "", "status.running": "", "status.completed": "",
+		                     "status.owner": "", "status.lease_expires": ""}}
+		if mark_failed:
+			now = datetime.datetime.utcnow()
+			update["$push"] = {"status.failed": now}
+			update["$set"]["next_eligible_at"] = now + self.retry_delay
+			if reason is not None:
+				update["$set"]["status.failure_reason"] = reason
+			else:
+				update["$unset"]["status.failure_reason"] = ""
+		return self._transition(self._owned_filter(name, owner), update) is not None
+
+	def _bulk_scopes(self, tournament, names):
+		# (tournament, filter) tuples to which a bulk operation is applied,
+		# either all jobs of a tournament or the named jobs grouped by
+		# tournament
+		if names is None:
+			if tournament is None:
+				raise ValueError("Either a tournament or job names must be given")
+			return [(tournament, {"tournament": tournament})]
+		by_tournament = {}
+		for name in names:
+			by_tournament.setdefault(WorkQueue.tournament_of(name), []).append(name)
+		if tournament is not None and set(by_tournament.keys()) - {tournament}:
+			raise ValueError("Jobs not of tournament %s given" % tournament)
+		return [(t, {"tournament": t, "name": {"$in": n}}) for (t, n) in by_tournament.items()]
+
+	def _bulk_transition(self, tournament, names, states, update, extra_filter=None,
+	                     failure_flags=[False, True], dry_run=False):
+		# Applies update to the jobs in one of the given states with one
+		# update_many per state and failure flag, so that the stats counters
+		# can be moved by the exact number of updated jobs. Returns the
+		# number of updated jobs, or of matching jobs on a dry run.
+		new_state = update.get("$set", {}).get("status.state")
+		adds_failure = "status.failed" in update.get("$push", {})
+		clears_failures = "status.failed" in update.get("$unset", {})
+		num_jobs = 0
+		for (t, filter) in self._bulk_scopes(tournament, names):
+			for state in states:
+				for has_failed in failure_flags:
+					f = dict(filter, **(extra_filter or {}))
+					f["status.state"] = state
+					f["status.failed.0"] = {"$exists": has_failed}
+					if dry_run:
+						num_jobs += self.collection.count(f)
+						continue
+					n = self.collection.update_many(f, update).matched_count
+					after = (new_state or state, (has_failed or adds_failure) and not clears_failures)
+					self._count_transition(t, (state, has_failed), after, n)
+					num_jobs += n
+		return num_jobs
+
+	def requeue_items(self, tournament=None, names=None, states=["completed"], mark_failed=True,
+	                  reason=None, dry_run=False):
+		# Returns jobs of a tournament or the named jobs in the given states
+		# to the queue. Returns the number of requeued jobs.
+		if "pending" in states:
+			raise ValueError("Cannot requeue pending jobs")
+		now = datetime.datetime.utcnow()
+		update = {"$set":   {"status.state": "pending", "next_eligible_at": now},
+		          "$unset": {"manifest_blobs": "", "status.running": "", "status.completed": "",
+		                     "status.owner": "", "status.lease_expires": ""}}
 		if mark_failed:
-			update["$push"] = {"status.failed": datetime.datetime.utcnow()}
-		self.collection.update_one(filter, update)
+			update["$push"] = {"status.failed": now}
+			update["$set"]["next_eligible_at"] = now + self.retry_delay
+			if reason is not None:
+				update["$set"]["status.failure_reason"] = reason
+			else:
+				update["$unset"]["status.failure_reason"] = ""
+		return self._bulk_transition(tournament, names, states, update, dry_run=dry_run)
+
+	def cancel_items(self, tournament=None, names=None, only_pending=True, dry_run=False):
+		# Cancels pending jobs, or all jobs which are not yet cancelled.
+		# Returns the number of cancelled jobs.
+		states = ["pending"] if only_pending else ["pending", "running", "completed"]
+		update = {"$set": {"status.state": "cancelled",
+		                   "status.cancelled": datetime.datetime.utcnow()},
+		          "$unset": {"status.owner": "", "status.lease_expires": ""}}
+		return self._bulk_transition(tournament, names, states, update, dry_run=dry_run)
+
+	def reset_failures(self, tournament=None, names=None, dry_run=False):
+		# Clears the failure history of pending jobs and makes them eligible
+		# immediately. Returns the number of reset jobs.
+		update = {"$set":   {"next_eligible_at": datetime.datetime.utcnow()},
+		          "$unset": {"status.failed": "", "status.failure_reason": ""}}
+		return self._bulk_transition(tournament, names, ["pending"], update,
+		                             failure_flags=[True], dry_run=dry_run)
+
+	def reprioritize_items(self, tournament=None, names=None, eligible_at=None, dry_run=False):
+		# Moves pending jobs in the claim order by setting their eligibility
+		# time, jobs are claimed oldest eligibility time first. The default
+		# moves them before all other jobs. Jobs waiting for a retry after a
+		# failure are not touched. Returns the number of moved jobs.
+		now = datetime.datetime.utcnow()
+		update = {"$set": {"next_eligible_at": eligible_at or datetime.datetime(1970, 1, 1)}}
+		return self._bulk_transition(tournament, names, ["pending"], update,
+		                             extra_filter={"next_eligible_at": {"$lte": now}},
+		                             dry_run=dry_run)
+
+	def renew_leases(self, owner):
+		# Extends the leases of all jobs held by owner, returns their number
+		filter = {"status.state": "running", "status.owner": owner}
+		update = {"$set": {"status.lease_expires": datetime.datetime.utcnow() + self.lease_duration}}
+		return self.collection.update_many(filter, update).modified_count
+
+	def holds_lease(self, name, owner):
+		return self.collection.find_one(self._owned_filter(name, owner), {"_id": 1}) is not None
+
+	def reap_expired_leases(self, dry_run=False, unleased_deadline=None):
+		# Returns running jobs whose lease has expired to the queue and
+		# records the expiry as a failure. Jobs claimed without a lease,
+		# e.g., by older controllers, are only considered if they have been
+		# running since before unleased_deadline.
+		# Returns a list of (name, owner) tuples of the reaped jobs.
+		now = datetime.datetime.utcnow()
+		conditions = [{"status.state": "running", "status.lease_expires": {"$lt": now}}]
+		if unleased_deadline is not None:
+			conditions.append({"status.state": "running",
+			                   "status.lease_expires": {"$exists": False},
+			                   "status.running": {"$lt": unleased_deadline}})
+		reaped = []
+		for condition in conditions:
+			for doc in self.collection.find(condition, {"name": 1, "status.owner": 1}):
+				owner = doc["status"].get("owner")
+				if not dry_run:
+					reason = "Lease of %s expired" % owner if owner else "Running without lease"
+					# Repeat the condition, the lease may have been renewed meanwhile
+					filter = dict(condition)
+					filter["_id"] = doc["_id"]
+					update = {"$set":   {"status.state": "pending",
+					                     "status.failure_reason": reason,
+					                     "next_eligible_at": now + self.retry_delay},
+					          "$push":  {"status.failed": now},
+					          "$unset": {"manifest_blobs": "", "status.running": "", "status.completed": "",
+					                     "status.owner": "", "status.lease_expires": ""}}
+					if self._transition(filter, update) is None:
+						continue
+				reaped.append((doc["name"], owner))
+		return reaped
+
+	def acquire_namespace_slot(self, prefix, num_slots, owner, lease_duration):
+		# Leases the lowest free job namespace <prefix><index> for index in
+		# [0, num_slots). Slots whose lease expired are free, their holder is
+		# assumed to have vanished. Returns a tuple (namespace, previous
+		# owner) or None if all slots are taken.
+		now = datetime.datetime.utcnow()
+		# Make sure all slot documents exist, existing ones stay untouched
+		docs = [{"_id": "%s%d" % (prefix, i), "prefix": prefix, "index": i,
+		         "owner": None, "expires": now} for i in range(num_slots)]
+		try:
+			self.slot_collection.insert_many(docs, ordered=False)
+		except BulkWriteError as e:
+			# 11000: duplicate key, i.e., the slot exists already
+			if any(error["code"] != 11000 for error in e.details.get("writeErrors", [])):
+				raise
+
+		filter = {"prefix": prefix, "index": {"$lt": num_slots},
+		          "$or": [{"owner": None}, {"expires": {"$lt": now}}]}
+		update = {"$set": {"owner": owner, "expires": now + lease_duration, "acquired": now}}
+		doc = self.slot_collection.find_one_and_update(filter, update,
+		                                               sort=[("index", pymongo.ASCENDING)],
+		                                               return_document=ReturnDocument.BEFORE)
+		if doc is None:
+			return None
+		return (doc["_id"], doc["owner"])
+
+	def renew_namespace_slot(self, namespace, owner, lease_duration):
+		# Returns False if the slot is no longer held by owner
+		filter = {"_id": namespace, "owner": owner}
+		update = {"$set": {"expires": datetime.datetime.utcnow() + lease_duration}}
+		return self.slot_collection.update_one(filter, update).matched_count > 0
+
+	def release_namespace_slot(self, namespace, owner):
+		filter = {"_id": namespace, "owner": owner}
+		update = {"$set": {"owner": None, "expires": datetime.datetime.utcnow()}}
+		self.slot_collection.update_one(filter, update)
 
 	def update_item(self, name, update):
 		filter = {"name": name}
-		self.collection.update_one(filter, update)
+		if "status.state" in update.get("$set", {}) or "status.failed" in update.get("$push", {}):
+			self._transition(filter, update)
+		else:
+			self.collection.update_one(filter, update)
+
+	def update_items(self, updates, batch_size=500):
+		# Applies (name, before, update) tuples with bulk writes, before is
+		# the (state, has failed) tuple of the job as read by the caller.
+		# Jobs which changed their state since are not updated. Returns the
+		# number of updated jobs.
+		groups = {}
+		for (name, before, update) in updates:
+			after = (update.get("$set", {}).get("status.state", before[0]),
+			         before[1] or "status.failed" in update.get("$push", {}))
+			filter = {"name": name, "status.state": before[0]}
+			key = (WorkQueue.tournament_of(name), before, after)
+			groups.setdefault(key, []).append(UpdateOne(filter, update))
+
+		num_updated = 0
+		for ((tournament, before, after), requests) in groups.items():
+			for batch_start in range(0, len(requests), batch_size):
+				batch = requests[batch_start:batch_start+batch_size]
+				n = self.collection.bulk_write(batch, ordered=False).matched_count
+				self._count_transition(tournament, before, after, n)
+				num_updated += n
+		return num_updated
+
+	def cancel_item(self, name, only_pending=True):
+		# Returns True if the job has been cancelled
+		filter = {"name": name, "status.state": "pending" if only_pending else {"$ne": "cancelled"}}
+		update = {"$set": {"status.state": "cancelled",
+		                   "status.cancelled": datetime.datetime.utcnow()},
+		          "$unset": {"status.owner": "", "status.lease_expires": ""}}
+		return self._transition(filter, update) is not None
 
 	def total_num_jobs(self):
 		return self.collection.count()
 
-	def num_pending_jobs(self, recently_failed_deadline=None, name_regex=None):
-		all_pending_filter = {"status.state": "pending"}
-		if name_regex is not None:
-			all_pending_filter["name"] = { "$regex": name_regex }
-		all_pending = self.collection.count(all_pending_filter)
+	def _stats(self, tournament=None):
+		# Counters of a single tournament or summed over all tournaments
+		filter = {"_id": tournament} if tournament is not None else {}
+		stats = {key: 0 for key in STATS_KEYS}
+		for doc in self.stats_collection.find(filter):
+			for key in STATS_KEYS:
+				stats[key] += doc.get(key, 0)
+		return stats
+
+	def _num_recently_failed(self, tournament=None):
+		# Answered by counting keys of the claim indexes
+		filter = {"status.state": "pending"}
+		if tournament is not None:
+			filter["tournament"] = tournament
+		filter["next_eligible_at"] = {"$gt": datetime.datetime.utcnow()}
+		return self.collection.count(filter)
+
+	def num_failing_jobs(self, min_failures, tournament=None):
+		# Number of pending jobs which failed at least min_failures times
+		filter = {"status.state": "pending",
+		          "status.failed.%d" % (min_failures - 1): {"$exists": True}}
+		if tournament is not None:
+			filter["tournament"] = tournament
+		return self.collection.count(filter)
+
+	def num_pending_jobs(self, include_recently_failed=False, tournament=None):
+		all_pending = self._stats(tournament)["pending"]
 
 		without_recently_failed = all_pending
-		if recently_failed_deadline is not None:
-			no_recently_failed_filter = {
-				"status.state": "pending",
-				"$or": [ {"status.failed": { "$exists": False} },
-				         {"status.failed": { "$size": 0} },
-				         {"status.failed": { "$elemMatch": { "$lte": recently_failed_deadline}}}]
-			}
-			if name_regex is not None:
-				no_recently_failed_filter["name"] = { "$regex": name_regex }
-			without_recently_failed = self.collection.count(no_recently_failed_filter)
+		if not include_recently_failed:
+			without_recently_failed = all_pending - self._num_recently_failed(tournament)
 
 		return (all_pending, without_recently_failed)
 
-	def job_stats(self, recently_failed_deadline, name_regex=None):
-		filter = {}
-		if name_regex is not None:
-			filter["name"] = { "$regex": name_regex }
+	def job_stats(self, tournament=None):
+		stats = self._stats(tournament)
+		stats["recently_failed"] = self._num_recently_failed(tournament)
+		return stats
 
+	def count_stats(self):
+		# Counts jobs per tournament and state from scratch
 		cursor = self.collection.aggregate(\
-		    [{"$match": filter},
-		     {"$facet": {
-			     "pending": [{"$match": { "status.state": "pending" }},
-			                 {"$count": "jobs"}],
-			     "running": [{"$match": { "status.state": "running" }},
-			                 {"$count": "jobs"}],
-			     "completed": [{"$match": { "status.state": "completed" }},
-			                   {"$count": "jobs"}],
-			     "cancelled": [{"$match": { "status.state": "cancelled" }},
-			                 {"$count": "jobs"}],
-			     "failed": [{"$match": { "status.state": "pending",
-			                             "$and": [ {"status.failed": { "$exists": True} },
-			                                       {"status.failed": { "$gt": [ "$size", 0] }} ]}}],
-			     "recently_failed": [{"$match": { "status.state": "pending",
-			                                      "$and": [ {"status.failed": { "$exists": True} },
-			                                                {"status.failed": { "$gt": ["$size", 0] }},
-			                                                {"status.failed": { "$all": [
-				                                                {"$elemMatch": {
-					                                                "$gt": recently_failed_deadline}}]}}]}}],
-		     }},
-		     {"$project": {
-			     "pending": {"$arrayElemAt": ["$pending.jobs", 0]},
-			     "running": {"$arrayElemAt": ["$running.jobs", 0]},
-			     "completed": {"$arrayElemAt": ["$completed.jobs", 0]},
-			     "cancelled": {"$arrayElemAt": ["$cancelled.jobs", 0]},
-			     "failed": {"$arrayElemAt": ["$failed.jobs", 0]},
-			     "recently_failed": {"$arrayElemAt": ["$recently_failed.jobs", 0]}}
-		     }])
-
-		d = cursor.next()
-		if d is not None:
-			return { "pending": d["pending"] if "pending" in d else 0,
-			         "running": d["running"] if "running" in d else 0,
-			         "completed": d["completed"] if "completed" in d else 0,
-			         "cancelled": d["cancelled"] if "cancelled" in d else 0,
-			         "failed": d["failed"] if "failed" in d else 0,
-			         "recently_failed": d["recently_failed"] if "recently_failed" in d else 0}
-		else:
-			return None
+		    [{"$group": {"_id": {"tournament": "$tournament",
+		                         "state": "$status.state",
+		                         "has_failed": {"$gt": [{"$size": {"$ifNull": ["$status.failed", []]}}, 0]}},
+		                 "jobs": {"$sum": 1}}}])
+		counts = {}
+		for d in cursor:
+			tournament = d["_id"]["tournament"]
+			if tournament not in counts:
+				counts[tournament] = {key: 0 for key in STATS_KEYS}
+			for (key, value) in WorkQueue._stats_contribution(d["_id"]["state"],
+			                                                  d["_id"]["has_failed"]).items():
+				counts[tournament][key] += value * d["jobs"]
+		return counts
+
+	def reconcile_stats(self, dry_run=False):
+		# Rebuilds the stats counters from the jobs. Transitions which happen
+		# while counting may cause new drift, preferably run on a quiet queue.
+		# Returns a dict mapping tournaments to a dict of counter differences
+		# (stored minus actual) for all counters which drifted.
+		counts = self.count_stats()
+		stored = {doc["_id"]: doc for doc in self.stats_collection.find()}
+		drift = {}
+		for tournament in set(counts.keys()) | set(stored.keys()):
+			actual = counts.get(tournament, {key: 0 for key in STATS_KEYS})
+			current = stored.get(tournament, {})
+			diff = {key: current.get(key, 0) - actual[key] for key in STATS_KEYS
+			        if current.get(key, 0) != actual[key]}
+			if diff:
+				drift[tournament] = diff
+			if not dry_run:
+				if tournament in counts:
+					self.stats_collection.replace_one({"_id": tournament}, actual, upsert=True)
+				else:
+					self.stats_collection.delete_one({"_id": tournament})
+		return drift